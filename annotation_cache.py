@@ -0,0 +1,100 @@
+"""
+Content-addressed cache of the CMDB annotation export for scope_builder.py.
+
+The export is hashed after every download.  For each tenant the cache keeps,
+under the hash of the last export seen and for each list of tier columns
+built from it:
+
+* the parsed annotation table (the tier columns plus the integer IP columns
+  from parse_ip_column), and
+* the collapsed and grouped scope list.
+
+An unchanged export therefore skips the CSV parse, the IP parse and the
+prefix collapse.  Only the tier columns of a run are kept, so the cached
+table stays as small as the table the run parses; a change of tier columns
+parses the export again.
+
+Tables are stored as Feather (Arrow IPC) files and memory-mapped back in when
+pyarrow is installed.  Without pyarrow the cache falls back to pickle files.
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from local_files import atomic_path, safe_name
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+EXTENSION = '.feather' if feather is not None else '.pkl'
+# Bumped when the layout of the annotation or grouped tables changes, so
+# tables cached by an earlier version are rebuilt
+TABLE_FORMAT = 3
+GROUPED_FORMAT = 5
+
+
+def file_digest(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AnnotationCache(object):
+    """
+    Per-tenant directory of cached tables named after the export hash.
+    """
+
+    def __init__(self, directory, tenant):
+        self.directory = os.path.join(directory, safe_name(tenant))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, digest, columns, grouped):
+        key = json.dumps([GROUPED_FORMAT if grouped else TABLE_FORMAT, grouped,
+                          columns]).encode('utf-8')
+        name = '{}-{}'.format(digest, hashlib.sha256(key).hexdigest()[:16])
+        return os.path.join(self.directory, name + EXTENSION)
+
+    def load(self, digest, columns, grouped=False):
+        """
+        Read a cached table of the tier columns: the annotation table, or the
+        scope list when grouped.  Returns None on a miss.
+        """
+        path = self._path(digest, columns, grouped)
+        if not os.path.exists(path):
+            return None
+        if feather is not None:
+            return feather.read_table(path, memory_map=True).to_pandas()
+        return pd.read_pickle(path)
+
+    def save(self, digest, df, columns, grouped=False):
+        """
+        Write a table of the tier columns.  Saving an annotation table of a
+        new export drops the tables of earlier exports of the tenant.
+        """
+        path = self._path(digest, columns, grouped)
+        if not grouped:
+            for name in os.listdir(self.directory):
+                if not name.startswith(digest):
+                    os.remove(os.path.join(self.directory, name))
+        # Written aside and renamed so a failed run never leaves a torn file
+        with atomic_path(path) as partial:
+            if feather is not None:
+                feather.write_feather(df.reset_index(drop=True), partial)
+            else:
+                df.to_pickle(partial)
+
+
+def open_annotation_cache(site_config):
+    """
+    The annotation cache of a run, or None when it is disabled.
+    """
+    if not site_config.get('annotation_cache'):
+        return None
+    return AnnotationCache(site_config['annotation_cache'], site_config['tenant'])
@@ -0,0 +1,162 @@
+"""
+End-to-end benchmark of scope_builder.py and clean.py against the local fake
+Tetration API in fake_tetration.py.
+
+The benchmark serves an annotation file as the CMDB export of a fresh tenant,
+builds and pushes the scope tree with build_scopes, runs it again (nothing
+left to create), seeds application workspaces, inventory filters and agent
+config intents on the new scopes and then tears everything down again with
+clean.  It reports the wall time, the time spent in each step of the scripts
+and the server-side request counts of each phase as JSON.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import clean
+import scope_builder
+from fake_tetration import FakeTetration, start_server
+from run_metrics import RunMetrics
+
+
+def run_phase(name, cluster, func, verbose=False):
+    cluster.reset_counters()
+    metrics = RunMetrics(name)
+    output = io.StringIO()
+    start = time.time()
+    if verbose:
+        func(metrics)
+    else:
+        with contextlib.redirect_stdout(output):
+            func(metrics)
+    wall_time = time.time() - start
+    result = {'phase': name, 'wall_time': round(wall_time, 3),
+              'steps': dict((step, round(x['wall_time'], 3))
+                            for step, x in metrics.report()['phases'].items())}
+    result.update(cluster.counters())
+    return result
+
+
+def seed_workspaces(cluster, root_scope_id, vrf_id, apps, filters):
+    """
+    Give clean something to tear down besides the scopes themselves.
+    """
+    scopes = cluster.tenant_scopes(root_scope_id)
+    for i in range(apps):
+        cluster.add_application(random.choice(scopes)['id'], primary=i % 2 == 0,
+                                enforcement_enabled=i % 3 == 0)
+    for i in range(filters):
+        cluster.add_intent(cluster.add_filter(vrf_id))
+
+
+def main():
+    """
+    Main execution routine
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark scope_builder.py and clean.py end to end against a local fake Tetration API.')
+    parser.add_argument('--annotations', default='sample_annotations.csv',
+                        help='Annotation CSV served as the CMDB export')
+    parser.add_argument('--columns', default=None,
+                        help='Comma delimited scope tree columns (default: every column except IP)')
+    parser.add_argument('--tenant', default='Bench', help='Root scope name')
+    parser.add_argument('--vrf_id', default=1, type=int, help='VRF id of the root scope')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='Seconds added to every request')
+    parser.add_argument('--error_rate', default=0.0, type=float,
+                        help='Fraction of requests failed with a 503')
+    parser.add_argument('--rate_limit', default=0, type=int,
+                        help='Requests per second before answering 429 (0 disables)')
+    parser.add_argument('--max_in_flight', default=8, type=int,
+                        help='Maximum number of scope create requests in flight at once')
+    parser.add_argument('--apps', default=20, type=int,
+                        help='Application workspaces to seed before cleaning')
+    parser.add_argument('--filters', default=20, type=int,
+                        help='Inventory filters (each with an intent) to seed before cleaning')
+    parser.add_argument('--cache_ttl', default=300, type=int,
+                        help='Scope cache TTL in seconds (0 runs without the cache)')
+    parser.add_argument('--abbreviation_rules', default='',
+                        help='Abbreviation rules file for the unattended build')
+    parser.add_argument('--output', default=None, help='Also write the JSON report to this file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the output of the scripts being benchmarked')
+    args = parser.parse_args()
+
+    with open(args.annotations) as f:
+        annotations = f.read()
+    if args.columns:
+        columns = [column.strip() for column in args.columns.split(',')]
+    else:
+        columns = [x for x in next(csv.reader(io.StringIO(annotations))) if x != 'IP']
+
+    cluster = FakeTetration(latency=args.latency, error_rate=args.error_rate,
+                            rate_limit=args.rate_limit)
+    root_scope_id = cluster.add_tenant(args.tenant, vrf_id=args.vrf_id,
+                                       annotations=annotations)
+    server, url = start_server(cluster)
+
+    fd, creds = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'api_key': 'bench', 'api_secret': 'bench'}, f)
+    cache_dir = tempfile.mkdtemp()
+
+    site_config = {
+        'url': url,
+        'creds': creds,
+        'tenant': args.tenant,
+        'push_scopes': True,
+        'command': 'build',
+        'max_in_flight': args.max_in_flight,
+        'ingest_chunksize': 0,
+        'plan_file': os.devnull,
+        'scope_cache': os.path.join(cache_dir, 'scope_cache.db') if args.cache_ttl else '',
+        'annotation_cache': os.path.join(cache_dir, 'annotations'),
+        'cache_ttl': args.cache_ttl,
+        'unattended': True,
+        'abbreviation_rules': args.abbreviation_rules,
+    }
+    tenant_config = {'columns': columns, 'abbreviations': {}}
+
+    try:
+        build = run_phase('build_scopes', cluster,
+                          lambda metrics: scope_builder.build_scopes(
+                              site_config, tenant_config, metrics),
+                          verbose=args.verbose)
+        scopes_created = len(cluster.tenant_scopes(root_scope_id)) - 1
+        rebuild = run_phase('rebuild_scopes', cluster,
+                            lambda metrics: scope_builder.build_scopes(
+                                site_config, tenant_config, metrics),
+                            verbose=args.verbose)
+        seed_workspaces(cluster, root_scope_id, args.vrf_id, args.apps, args.filters)
+        teardown = run_phase('clean', cluster, lambda metrics: clean.clean(site_config, metrics),
+                             verbose=args.verbose)
+    finally:
+        server.shutdown()
+        os.remove(creds)
+        shutil.rmtree(cache_dir)
+
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'verbose')},
+        'columns': columns,
+        'scopes_created': scopes_created,
+        'scopes_remaining': len(cluster.tenant_scopes(root_scope_id)) - 1,
+        'applications_remaining': len(cluster.applications),
+        'filters_remaining': len(cluster.filters),
+        'phases': [build, rebuild, teardown],
+    }
+    print(json.dumps(report, indent=1))
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""
+Offline benchmark of the annotation pipeline of scope_builder.py, without a
+cluster.
+
+Each step of build_scopes between the download and the first API call runs
+on its own, on the output of the step before it:
+
+* ingest: read_annotations and parse_ip_column,
+* collapse: longest prefix match with collapse_prefix_tags,
+* group: the scope list with group_paths,
+* profile: the column profiles of the abbreviation checks,
+* abbreviations: auto_abbreviate with the rules file,
+* names: the full scope names with scope_names,
+* plan: plan_scopes against a tree with only the root scope.
+
+With --shard_workers over 1 the ingest parses in that many processes and
+one more step, sharded, builds the scope list from the ingest output with
+the sharded group_scopes.
+
+Every step runs --repeat times and the fastest run counts.  One more run is
+traced with tracemalloc for the peak memory the step allocates.  The
+annotation file is either given or generated with generate_annotations.py.
+
+With --baseline the report is compared with a stored one.  A step is a
+regression when it is more than --tolerance slower than the baseline, and
+also more than --min_seconds slower.  The same rule applies to its peak
+memory, with --min_memory as the floor.  Any regression exits with status 1.
+--save_baseline stores the report as the new baseline.
+"""
+
+import argparse
+import contextlib
+import csv
+import gc
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import scope_builder
+from annotation_cache import file_digest
+from generate_annotations import generate, parse_count
+from run_metrics import RunMetrics
+
+ROOT_SCOPE_NAME = 'Bench'
+
+
+def pipeline(file_path, columns, rules, shard_workers=0):
+    """
+    The steps of the benchmark as (name, function) pairs.  Each function
+    takes the outputs of the steps before it by name and returns its own.
+    """
+    def ingest(outputs):
+        df = scope_builder.read_annotations(file_path, columns)
+        return df.join(scope_builder.parse_ips(df.pop('IP'), shard_workers))
+
+    def profile(outputs):
+        # Cached profiles would turn every run after the first into a lookup
+        scope_builder._profiles.clear()
+        return scope_builder.profile_columns(outputs['group'], columns)
+
+    def abbreviations(outputs):
+        abbreviations = {}
+        scope_builder.auto_abbreviate(outputs['group'], columns, ROOT_SCOPE_NAME,
+                                      abbreviations, rules, outputs['profile'])
+        return abbreviations
+
+    steps = [
+        ('ingest', ingest),
+        ('collapse', lambda outputs: scope_builder.collapse_prefix_tags(
+            outputs['ingest'], columns)),
+        ('group', lambda outputs: scope_builder.group_paths(
+            outputs['collapse'], columns)),
+        ('profile', profile),
+        ('abbreviations', abbreviations),
+        ('names', lambda outputs: scope_builder.scope_names(
+            outputs['group'], columns, ROOT_SCOPE_NAME, outputs['abbreviations'])),
+        ('plan', lambda outputs: scope_builder.plan_scopes(
+            outputs['group'], columns, ROOT_SCOPE_NAME,
+            scope_builder.ScopeTree(ROOT_SCOPE_NAME), outputs['abbreviations'],
+            prompt=False)),
+    ]
+    if shard_workers > 1:
+        steps.append(('sharded', lambda outputs: scope_builder.group_scopes(
+            outputs['ingest'], columns, workers=shard_workers)))
+    return steps
+
+
+def run_step(name, func, outputs, repeat, verbose=False):
+    """
+    Time one step repeat times and trace one more run.  Returns the step's
+    figures and its output.
+    """
+    result = {'wall_time': None, 'cpu_time': None}
+    output = None
+    log = io.StringIO()
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(log))
+        for _ in range(max(repeat, 1)):
+            output = None
+            gc.collect()
+            metrics = RunMetrics('bench_pipeline')
+            with metrics.phase(name):
+                output = func(outputs)
+            phase = metrics.report()['phases'][name]
+            for key in ('wall_time', 'cpu_time'):
+                if result[key] is None or phase[key] < result[key]:
+                    result[key] = phase[key]
+            result['max_rss'] = phase['max_rss']
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func(outputs)
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    for key in ('wall_time', 'cpu_time'):
+        result[key] = round(result[key], 4)
+    return result, output
+
+
+def compare(report, baseline, tolerance, min_seconds, min_memory):
+    """
+    Return the steps of report that regressed against baseline.
+    """
+    regressions = []
+    for name, step in report['steps'].items():
+        before = baseline['steps'].get(name)
+        if before is None:
+            continue
+        for key, floor in (('wall_time', min_seconds), ('peak_memory', min_memory)):
+            if before.get(key) is None or step.get(key) is None:
+                continue
+            if step[key] > before[key] * (1 + tolerance) and step[key] - before[key] > floor:
+                regressions.append({'step': name, 'metric': key,
+                                    'baseline': before[key], 'value': step[key]})
+    return regressions
+
+
+def main():
+    """
+    Main execution routine
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the annotation pipeline of scope_builder.py step by step, without a cluster.')
+    parser.add_argument('--annotations', default=None,
+                        help='Annotation CSV to benchmark (default: generate one with --rows rows)')
+    parser.add_argument('--rows', default='100k',
+                        help='Rows of the generated annotation file (ex: 10k, 100k, 1M, 10M)')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Random seed of the generated annotation file')
+    parser.add_argument('--columns', default=None,
+                        help='Comma delimited scope tree columns (default: every column except IP)')
+    parser.add_argument('--abbreviation_rules', default='',
+                        help='Abbreviation rules file for auto_abbreviate')
+    parser.add_argument('--shard_workers', default=0, type=int,
+                        help='Processes of the parse and of the extra sharded step (0 or 1 leaves both out)')
+    parser.add_argument('--repeat', default=3, type=int,
+                        help='Timed runs of each step; the fastest counts')
+    parser.add_argument('--baseline', default=None,
+                        help='Report of an earlier run to check for regressions')
+    parser.add_argument('--save_baseline', default=None,
+                        help='Write the report to this file as the new baseline')
+    parser.add_argument('--tolerance', default=0.25, type=float,
+                        help='Fraction a step may be slower or use more memory than the baseline')
+    parser.add_argument('--min_seconds', default=0.05, type=float,
+                        help='Slowdowns up to this many seconds are never regressions')
+    parser.add_argument('--min_memory', default=16, type=float,
+                        help='Memory growth up to this many MB is never a regression')
+    parser.add_argument('--output', default=None, help='Also write the JSON report to this file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the output of the steps being benchmarked')
+    args = parser.parse_args()
+
+    generated = None
+    file_path = args.annotations
+    if file_path is None:
+        fd, generated = tempfile.mkstemp(prefix='bench_annotations_', suffix='.csv')
+        os.close(fd)
+        file_path = generated
+        start = time.time()
+        generate(file_path, parse_count(args.rows), ['Org', 'Region', 'Zone', 'App', 'Env'],
+                 [5, 20, 200, 2000, 6], seed=args.seed)
+        print('Generated {} rows in {:.1f}s'.format(args.rows, time.time() - start),
+              file=sys.stderr)
+
+    try:
+        if args.columns:
+            columns = [column.strip() for column in args.columns.split(',')]
+        else:
+            with open(file_path, newline='') as f:
+                header = next(csv.reader(f))
+            columns = [x for x in header if x != 'IP']
+        rules = scope_builder.load_abbreviation_rules(args.abbreviation_rules)
+
+        steps = {}
+        outputs = {}
+        for name, func in pipeline(file_path, columns, rules, args.shard_workers):
+            steps[name], outputs[name] = run_step(name, func, outputs, args.repeat,
+                                                  args.verbose)
+            print('{:<14} {:>9.3f}s wall {:>9.3f}s CPU {:>9.1f} MB peak'.format(
+                name, steps[name]['wall_time'], steps[name]['cpu_time'],
+                steps[name]['peak_memory'] / 2 ** 20), file=sys.stderr)
+        report = {
+            'config': {k: v for k, v in vars(args).items()
+                       if k in ('annotations', 'rows', 'seed', 'abbreviation_rules', 'repeat',
+                                'shard_workers')},
+            'input': {'digest': file_digest(file_path), 'columns': columns,
+                      'annotation_rows': len(outputs['ingest']),
+                      'scope_rows': len(outputs['group']),
+                      'planned_scopes': len(outputs['plan'][0])},
+            'steps': steps,
+        }
+    finally:
+        if generated:
+            os.remove(generated)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['input']['digest'] != report['input']['digest'] or \
+                baseline['input']['columns'] != columns:
+            print('The baseline in {} was recorded for a different annotation file or columns.'.format(
+                args.baseline), file=sys.stderr)
+            sys.exit(2)
+        report['regressions'] = compare(report, baseline, args.tolerance,
+                                        args.min_seconds, args.min_memory * 2 ** 20)
+        for regression in report['regressions']:
+            print('[REGRESSION] {step} {metric}: {baseline} -> {value}'.format(**regression),
+                  file=sys.stderr)
+        status = 1 if report['regressions'] else 0
+
+    print(json.dumps(report, indent=1))
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as outfile:
+                json.dump(report, outfile, indent=1)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
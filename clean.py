@@ -1,230 +1,292 @@
-import urllib3
 import ipaddress
-from tetpyclient import RestClient
+from tet_client import get_client
+from scope_cache import open_cache, tenant_scopes
+from run_metrics import RunMetrics, collect_metrics
 import json
 import os
-import time
 import getpass
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
-def clean(site_config):
-    restclient = RestClient(site_config['url'],
-                            credentials_file=site_config['creds'], verify=False)
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-    errors = []
-    root_scope_name = site_config['tenant']
+def discover_scopes(restclient, current_scopes, app_scope_id, errors):
+    """
+    Return the ids of every scope below app_scope_id grouped by depth: the
+    first list holds the children of app_scope_id, the next one their
+    children, and so on.
 
-    # Gather existing scopes and IDs
-    resp = restclient.get('/openapi/v1/app_scopes/')
-    if resp.status_code == 200:
-        current_scopes = resp.json()
-        root_scope = [
-            x for x in current_scopes if x['name'] == root_scope_name]
-        app_scope_id = root_scope[0]['id']
-        vrf_id = root_scope[0]['query']['value']
+    The parent/child index is built locally from the bulk app_scopes listing.
+    Only when the listing does not carry parent_app_scope_id do we fall back
+    to walking the tree with one GET per scope.
+    """
+    children = {}
+    indexed = False
+    for scope in current_scopes:
+        if 'parent_app_scope_id' in scope:
+            indexed = True
+            if scope['parent_app_scope_id']:
+                children.setdefault(
+                    scope['parent_app_scope_id'], []).append(scope['id'])
 
-    # -------------------------------------------------------------------------
-    # DETERMINE SCOPES TO BE DELETED
-    # Using two lists here as queues:
-    # 1. toBeExamined is a FIFO where we add parent scopes at position zero and
-    #    use pop to remove them from the end. We add one entire heirarchical
-    #    level of parents before we add a single one of their children. This
-    #    process will continue until there are no more children to add and the
-    #    FIFO will eventually be empty.
-    # 2. toBeDeleted is a LIFO where we append parent scopes at the end before
-    #    we append their children. Later, we will pop scopes from the end when
-    #    deleting them, so child scopes will always be deleted before their
-    #    parents (which is required by Tetration).
-
-    print "[CHECKING] all scopes in Tetration."
-    toBeDeleted = []
-    toBeExamined = [app_scope_id]
+    levels = []
+    toBeExamined = deque([(app_scope_id, 0)])
     while len(toBeExamined):
-        scopeId = toBeExamined.pop()
-        resp = restclient.get('/openapi/v1/app_scopes/' + scopeId)
-        if resp.status_code == 200:
-            for scope in resp.json()["child_app_scope_ids"]:
-                toBeExamined.insert(0, scope)
-                toBeDeleted.append(scope)
+        scopeId, depth = toBeExamined.popleft()
+        if indexed:
+            child_ids = children.get(scopeId, [])
         else:
-            print "[ERROR] examining scope '{}'. This will cause problems deleting all scopes.".format(
-                scopeId)
-            errors.append(
-                "[ERROR] examining scope '{}'. This will cause problems deleting all scopes.".format(scopeId))
-            print resp, resp.text
+            resp = restclient.get('/openapi/v1/app_scopes/' + scopeId)
+            if resp.status_code == 200:
+                child_ids = resp.json()["child_app_scope_ids"]
+            else:
+                print("[ERROR] examining scope '{}'. This will cause problems deleting all scopes.".format(
+                    scopeId))
+                errors.append(
+                    "[ERROR] examining scope '{}'. This will cause problems deleting all scopes.".format(scopeId))
+                print(resp, resp.text)
+                child_ids = []
+        if len(child_ids) and len(levels) == depth:
+            levels.append([])
+        for child_id in child_ids:
+            levels[depth].append(child_id)
+            toBeExamined.append((child_id, depth + 1))
+    return levels
 
-    # -------------------------------------------------------------------------
-    # DELETE THE WORKSPACES
-    # Walk through all applications and remove any in a scope that should be
-    # deleted. In order to delete an application, we have to turn off enforcing
-    # and make it secondary first.
 
-    resp = restclient.get('/openapi/v1/applications/')
-    if resp.status_code == 200:
-        resp_data = resp.json()
+def run_wave(name, items, action, errors, max_in_flight):
+    """
+    Run action on every item of one teardown wave concurrently, with at most
+    max_in_flight requests outstanding, and wait for the whole wave.
+    """
+    if len(items) == 0:
+        return
+    print("[WAVE] {} ({} items).".format(name, len(items)))
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = dict((executor.submit(action, item), item) for item in items)
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("[ERROR] {} {}: {}".format(name, futures[future], e))
+                errors.append("[ERROR] {} {}: {}".format(name, futures[future], e))
+
+
+def delete_application(restclient, app, errors):
+    """
+    Delete one application workspace. In order to delete an application, we
+    have to turn off enforcing and make it secondary first.
+    """
+    app_id = app["id"]
+    appName = app["name"]
+    # first we turn off enforcement
+    if app["enforcement_enabled"]:
+        r = restclient.post(
+            '/openapi/v1/applications/' + app_id + '/disable_enforce')
+        if r.status_code == 200:
+            print("[CHANGED] app {} ({}) to not enforcing.".format(
+                app_id, appName))
+        else:
+            print("[ERROR] changing app {} ({}) to not enforcing.".format(
+                app_id, appName))
+            errors.append(
+                "[ERROR] changing app {} ({}) to not enforcing. Details: {} -- {}".format(app_id, appName, r, r.text))
+            return
+    # make the application secondary if it is primary
+    if app["primary"]:
+        req_payload = {"primary": "false"}
+        r = restclient.put(
+            '/openapi/v1/applications/' + app_id, json_body=json.dumps(req_payload))
+        if r.status_code == 200:
+            print("[CHANGED] app {} ({}) to secondary.".format(
+                app_id, appName))
+        else:
+            print("[ERROR] changing app {} ({}) to secondary.".format(
+                app_id, appName))
+            errors.append(
+                "[ERROR] changing app {} ({}) to secondary. Details: {} -- {}".format(app_id, appName, r, r.text))
+            return
+    # now delete the app
+    r = restclient.delete('/openapi/v1/applications/' + app_id)
+    if r.status_code == 200:
+        print("[REMOVED] app {} ({}) successfully.".format(
+            app_id, appName))
     else:
-        print "[ERROR] reading application workspaces to determine which ones should be deleted."
+        print("[ERROR] deleting {} ({}).".format(app_id, appName))
         errors.append(
-            "[ERROR] reading application workspaces to determine which ones should be deleted.")
-        print resp, resp.text
-        resp_data = {}
-    for app in resp_data:
-        appName = app["name"]
-        if app["app_scope_id"] in toBeDeleted or app["app_scope_id"] == app_scope_id:
-            app_id = app["id"]
-            # first we turn off enforcement
-            if app["enforcement_enabled"]:
-                r = restclient.post('/openapi/v1/applications/' +
-                                    app_id + '/disable_enforce')
-                if r.status_code == 200:
-                    print "[CHANGED] app {} ({}) to not enforcing.".format(
-                        app_id, appName)
-                else:
-                    print "[ERROR] changing app {} ({}) to not enforcing. Trying again...".format(
-                        app_id, appName)
-                    time.sleep(1)
-                    r = restclient.post(
-                        '/openapi/v1/applications/' + app_id + '/disable_enforce')
-                    if r.status_code == 200:
-                        print "[CHANGED] app {} ({}) to not enforcing.".format(
-                            app_id, appName)
-                    else:
-                        errors.append(
-                            "[ERROR] Failed again. Details: {} -- {}".format(resp, resp.text))
-                        print resp, resp.text
-            # make the application secondary if it is primary
-            if app["primary"]:
-                req_payload = {"primary": "false"}
-                r = restclient.put('/openapi/v1/applications/' +
-                                   app_id, json_body=json.dumps(req_payload))
-                if r.status_code == 200:
-                    print "[CHANGED] app {} ({}) to secondary.".format(
-                        app_id, appName)
-                else:
-                    # Wait and try again
-                    print "[ERROR] changing app {} ({}) to secondary. Trying again...".format(
-                        app_id, appName)
-                    time.sleep(1)
-                    r = restclient.post(
-                        '/openapi/v1/applications/' + app_id + '/disable_enforce')
-                    if r.status_code == 200:
-                        print "[CHANGED] app {} ({}) to not enforcing.".format(
-                            app_id, appName)
-                    else:
-                        errors.append(
-                            "[ERROR] Failed again. Details: {} -- {}".format(resp, resp.text))
-                        print resp, resp.text
-            # now delete the app
-            r = restclient.delete('/openapi/v1/applications/' + app_id)
-            if r.status_code == 200:
-                print "[REMOVED] app {} ({}) successfully.".format(
-                    app_id, appName)
-            else:
-                # Wait and try again
-                print "[ERROR] deleting {} ({}). Trying again...".format(
-                    app_id, appName)
-                time.sleep(1)
-                r = restclient.delete('/openapi/v1/applications/' + app_id)
-                if r.status_code == 200:
-                    print "[REMOVED] app {} ({}) successfully.".format(
-                        app_id, appName)
-                else:
-                    errors.append(
-                        "[ERROR] Failed again. Details: {} -- {}".format(resp, resp.text))
-                    print resp, resp.text
-
-    # -------------------------------------------------------------------------
-    # DETERMINE ALL FILTERS ASSOCIATED WITH THIS VRF_ID
-    # Inventory filters have a query that the user enters but there is also a
-    # query for the vrf_id to match. So we simply walk through all filters and
-    # look for that query to match this vrf_id... if there is a match then
-    # mark the filter as a target for deletion.  Before deleting filters,
-    # we need to delete the agent config intents
-
-    filtersToBeDeleted = []
-
-    resp = restclient.get('/openapi/v1/filters/inventories')
-    if resp.status_code == 200:
-        resp_data = resp.json()
+            "[ERROR] deleting {} ({}). Details: {} -- {}".format(app_id, appName, r, r.text))
+
+
+def delete_intent(restclient, intent_id, errors):
+    r = restclient.delete(
+        '/openapi/v1/inventory_config/intents/' + intent_id)
+    if r.status_code == 200:
+        print("[REMOVED] inventory config intent {}.".format(intent_id))
     else:
-        print "[ERROR] reading filters to determine which ones should be deleted."
+        print("[ERROR] removing inventory config intent {}.".format(
+            intent_id))
         errors.append(
-            "[ERROR] reading filters to determine which ones should be deleted.")
-        print resp, resp.text
-        resp_data = {}
-    for filt in resp_data:
-        try:
-            inventory_filter_id = filt["id"]
-            filterName = filt["name"]
-            for query in filt["query"]["filters"]:
-                if 'field' in query.iterkeys() and query["field"] == "vrf_id" and query["value"] == int(vrf_id):
-                    filtersToBeDeleted.append(
-                        {'id': inventory_filter_id, 'name': filterName})
-        except:
-            print(json.dumps(filt))
-
-    # -------------------------------------------------------------------------
-    # DELETE AGENT CONFIG INTENTS
-    # Look through all agent config intents and delete instances that are based
-    # on a filter or scope in filtersToBeDeleted or toBeDeleted (scopes)
-
-    print "[CHECKING] all inventory config intents in Tetration."
-
-    resp = restclient.get('/openapi/v1/inventory_config/intents')
+            "[ERROR] removing inventory config intent {}.".format(intent_id))
+        print(r, r.text)
+
+
+def delete_filter(restclient, filt, errors):
+    r = restclient.delete(
+        '/openapi/v1/filters/inventories/' + filt['id'])
+    if r.status_code == 200:
+        print("[REMOVED] inventory filter {} named '{}'.".format(
+            filt['id'], filt['name']))
+    else:
+        print("[ERROR] removing inventory filter {} named '{}'.".format(
+            filt['id'], filt['name']))
+        errors.append("[ERROR] removing inventory filter {} named '{}'.".format(
+            filt['id'], filt['name']))
+        print(r, r.text)
+
+
+def delete_scope(restclient, scopeId, errors, cache=None):
+    resp = restclient.delete('/openapi/v1/app_scopes/' + scopeId)
     if resp.status_code == 200:
-        resp_data = resp.json()
+        print("[REMOVED] scope {} successfully.".format(scopeId))
+        if cache is not None:
+            cache.remove(scopeId)
     else:
-        print "[ERROR] reading inventory config intents to determine which ones should be deleted."
-        errors.append(
-            "[ERROR] reading inventory config intents to determine which ones should be deleted.")
-        print resp, resp.text
-        resp_data = {}
-    for intent in resp_data:
-        intent_id = intent['id']
-        filter_id = intent["inventory_filter_id"]
-        if filter_id in filtersToBeDeleted or filter_id in toBeDeleted or filter_id == app_scope_id:
-            r = restclient.delete(
-                '/openapi/v1/inventory_config/intents/' + intent_id)
-            if r.status_code == 200:
-                print "[REMOVED] inventory config intent {}.".format(intent_id)
+        print("[ERROR] removing scope {}.".format(scopeId))
+        errors.append("[ERROR] removing scope {}.".format(scopeId))
+        print(resp, resp.text)
+
+
+def clean(site_config, metrics=None):
+    metrics = metrics or RunMetrics('clean', site_config['tenant'])
+    restclient = get_client(site_config, metrics)
+    max_in_flight = site_config.get('max_in_flight', 8)
+
+    with open_cache(site_config) as cache:
+        errors = []
+        root_scope_name = site_config['tenant']
+
+        # Gather existing scopes and IDs
+        with metrics.phase('inventory'):
+            current_scopes = tenant_scopes(restclient, root_scope_name, cache)
+        if not current_scopes:
+            print("[ERROR] reading the scopes of {}.".format(root_scope_name))
+            errors.append("[ERROR] reading the scopes of {}.".format(root_scope_name))
+            metrics.count('errors', len(errors))
+            return errors
+        root_scope = [
+            x for x in current_scopes if x['name'] == root_scope_name]
+        app_scope_id = root_scope[0]['id']
+        vrf_id = root_scope[0]['query']['value']
+
+        # -------------------------------------------------------------------------
+        # DETERMINE SCOPES TO BE DELETED
+        # Scopes are grouped by depth below the root scope. They are deleted one
+        # level at a time starting with the deepest, so child scopes are always
+        # deleted before their parents (which is required by Tetration).
+
+        print("[CHECKING] all scopes in Tetration.")
+        with metrics.phase('discover'):
+            scopeLevels = discover_scopes(restclient, current_scopes, app_scope_id, errors)
+            toBeDeleted = set(scopeId for level in scopeLevels for scopeId in level)
+        metrics.count('scopes', len(toBeDeleted))
+
+        # -------------------------------------------------------------------------
+        # DELETE THE WORKSPACES
+        # Walk through all applications and remove any in a scope that should be
+        # deleted. Each application runs its own disable enforcement, make
+        # secondary, delete sequence and all applications run concurrently.
+
+        with metrics.phase('applications'):
+            resp = restclient.get('/openapi/v1/applications/')
+            if resp.status_code == 200:
+                resp_data = resp.json()
             else:
-                print "[ERROR] removing inventory config intent {}.".format(
-                    intent_id)
+                print("[ERROR] reading application workspaces to determine which ones should be deleted.")
                 errors.append(
-                    "[ERROR] removing inventory config intent {}.".format(intent_id))
-                print r, r.text
+                    "[ERROR] reading application workspaces to determine which ones should be deleted.")
+                print(resp, resp.text)
+                resp_data = {}
+            appsToBeDeleted = [app for app in resp_data if app["app_scope_id"]
+                               in toBeDeleted or app["app_scope_id"] == app_scope_id]
+            metrics.count('applications', len(appsToBeDeleted))
+            run_wave("deleting application workspaces", appsToBeDeleted,
+                     lambda app: delete_application(restclient, app, errors), errors, max_in_flight)
 
-    # -------------------------------------------------------------------------
-    # DELETE THE FILTERS
+        # -------------------------------------------------------------------------
+        # DETERMINE ALL FILTERS ASSOCIATED WITH THIS VRF_ID
+        # Inventory filters have a query that the user enters but there is also a
+        # query for the vrf_id to match. So we simply walk through all filters and
+        # look for that query to match this vrf_id... if there is a match then
+        # mark the filter as a target for deletion.  Before deleting filters,
+        # we need to delete the agent config intents
 
-    while len(filtersToBeDeleted):
-        filterId = filtersToBeDeleted.pop()
-        r = restclient.delete(
-            '/openapi/v1/filters/inventories/' + filterId['id'])
-        if r.status_code == 200:
-            print "[REMOVED] inventory filter {} named '{}'.".format(
-                filterId['id'], filterId['name'])
-        else:
-            print "[ERROR] removing inventory filter {} named '{}'.".format(
-                filterId['id'], filterId['name'])
-            errors.append("[ERROR] removing inventory filter {} named '{}'.".format(
-                filterId['id'], filterId['name']))
-            print r, r.text
-
-    # -------------------------------------------------------------------------
-    # DELETE THE SCOPES
-
-    while len(toBeDeleted):
-        scopeId = toBeDeleted.pop()
-        resp = restclient.delete('/openapi/v1/app_scopes/' + scopeId)
-        if resp.status_code == 200:
-            print "[REMOVED] scope {} successfully.".format(scopeId)
-        else:
-            print "[ERROR] removing scope {}.".format(scopeId)
-            errors.append("[ERROR] removing scope {}.".format(scopeId))
-            print resp, resp.text
+        filtersToBeDeleted = {}
+
+        with metrics.phase('filters'):
+            resp = restclient.get('/openapi/v1/filters/inventories')
+            if resp.status_code == 200:
+                resp_data = resp.json()
+            else:
+                print("[ERROR] reading filters to determine which ones should be deleted.")
+                errors.append(
+                    "[ERROR] reading filters to determine which ones should be deleted.")
+                print(resp, resp.text)
+                resp_data = {}
+            for filt in resp_data:
+                try:
+                    inventory_filter_id = filt["id"]
+                    filterName = filt["name"]
+                    for query in filt["query"]["filters"]:
+                        if 'field' in query and query["field"] == "vrf_id" and query["value"] == int(vrf_id):
+                            filtersToBeDeleted[inventory_filter_id] = {
+                                'id': inventory_filter_id, 'name': filterName}
+                except:
+                    print(json.dumps(filt))
+        metrics.count('filters', len(filtersToBeDeleted))
+
+        # -------------------------------------------------------------------------
+        # DELETE AGENT CONFIG INTENTS
+        # Look through all agent config intents and delete instances that are based
+        # on a filter or scope in filtersToBeDeleted or toBeDeleted (scopes)
+
+        print("[CHECKING] all inventory config intents in Tetration.")
+
+        with metrics.phase('intents'):
+            resp = restclient.get('/openapi/v1/inventory_config/intents')
+            if resp.status_code == 200:
+                resp_data = resp.json()
+            else:
+                print("[ERROR] reading inventory config intents to determine which ones should be deleted.")
+                errors.append(
+                    "[ERROR] reading inventory config intents to determine which ones should be deleted.")
+                print(resp, resp.text)
+                resp_data = {}
+            intentsToBeDeleted = []
+            for intent in resp_data:
+                filter_id = intent["inventory_filter_id"]
+                if filter_id in filtersToBeDeleted or filter_id in toBeDeleted or filter_id == app_scope_id:
+                    intentsToBeDeleted.append(intent['id'])
+            metrics.count('intents', len(intentsToBeDeleted))
+            run_wave("deleting inventory config intents", intentsToBeDeleted,
+                     lambda intent_id: delete_intent(restclient, intent_id, errors), errors, max_in_flight)
+
+        # -------------------------------------------------------------------------
+        # DELETE THE FILTERS
+
+        with metrics.phase('delete_filters'):
+            run_wave("deleting inventory filters", list(filtersToBeDeleted.values()),
+                     lambda filt: delete_filter(restclient, filt, errors), errors, max_in_flight)
+
+        # -------------------------------------------------------------------------
+        # DELETE THE SCOPES
+
+        with metrics.phase('delete_scopes'):
+            for depth in reversed(range(len(scopeLevels))):
+                run_wave("deleting scopes at depth {}".format(depth + 1), scopeLevels[depth],
+                         lambda scopeId: delete_scope(restclient, scopeId, errors, cache), errors, max_in_flight)
+
+        metrics.count('errors', len(errors))
+        return errors
 
 
 def main():
@@ -247,6 +309,33 @@ def main():
             'descr': 'Tetration Tenant Name',
             'env': 'SCOPE_BUILDER_TENANT',
             'conf': 'tenant'
+        },
+        'max_in_flight': {
+            'descr': 'Maximum number of delete requests in flight at once',
+            'conf': 'max_in_flight',
+                    'type': int,
+                    'default': 8
+        },
+        'scope_cache': {
+            'descr': 'SQLite file caching the scope inventory between runs (empty disables the cache)',
+            'conf': 'scope_cache',
+                    'default': 'scope_cache.db'
+        },
+        'cache_ttl': {
+            'descr': 'Seconds a cached scope inventory is used before it is refreshed from the cluster',
+            'conf': 'cache_ttl',
+                    'type': int,
+                    'default': 300
+        },
+        'metrics_file': {
+            'descr': 'JSON file for the phase timings, API request statistics and counts of the run (empty disables it)',
+            'conf': 'metrics_file',
+                    'default': 'clean_metrics.json'
+        },
+        'prometheus_file': {
+            'descr': 'Also write the run metrics to this Prometheus textfile collector file (ex: /var/lib/node_exporter/clean.prom)',
+            'conf': 'prometheus_file',
+                    'default': ''
         }
     }
 
@@ -262,7 +351,8 @@ def main():
             default = conf_vars[item]['default']
         elif 'env' in conf_vars[item]:
             default = os.environ.get(conf_vars[item]['env'], None)
-        parser.add_argument('--'+item, default=default, help=descr)
+        parser.add_argument('--'+item, default=default, help=descr,
+                            type=conf_vars[item].get('type', str))
     args = parser.parse_args()
 
     site_config = {}
@@ -273,12 +363,13 @@ def main():
                 site_config[conf_vars[arg]['conf']] = getpass.getpass(
                     '{}: '.format(conf_vars[arg]['descr']))
             else:
-                site_config[conf_vars[arg]['conf']] = raw_input(
+                site_config[conf_vars[arg]['conf']] = input(
                     '{}: '.format(conf_vars[arg]['descr']))
         else:
             site_config[conf_vars[arg]['conf']] = attribute
 
-    clean(site_config)
+    with collect_metrics(site_config, 'clean') as metrics:
+        clean(site_config, metrics)
 
 
 if __name__ == '__main__':
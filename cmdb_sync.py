@@ -0,0 +1,189 @@
+"""
+CMDB annotation transfer for scope_builder.py: the export download and a
+delta upload of a local annotation file.
+
+The local file is the source of truth.  Instead of uploading it whole, the
+current export of the root scope is downloaded and compared with it on the
+IP key (VRF and IP when the file has a VRF column):
+
+* rows with a new key, or with a different value in any column of the local
+  file, are uploaded with the add operation,
+* keys that are no longer in the local file are uploaded with the delete
+  operation.
+
+Rows are compared by a hash of their values, so only the keys and one hash
+per row are joined.  The changed rows are uploaded in batches of batch_size
+rows, max_in_flight batches at a time.  Columns of the export that the local
+file does not have are neither compared nor touched.
+"""
+
+import contextlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from tetpyclient import MultiPartOption
+
+from run_metrics import RunMetrics
+
+# Seconds allowed for one batch upload; the cluster parses the whole batch
+# before it answers
+UPLOAD_TIMEOUT = 300
+
+
+def download_annotations(rc, root_scope_name, file_path):
+    resp = rc.download(file_path, '/assets/cmdb/download/' + root_scope_name)
+    if resp.status_code != 200:
+        raise Exception('Error downloading annotations for {}: HTTP {}'.format(
+            root_scope_name, resp.status_code))
+
+
+@contextlib.contextmanager
+def downloaded_annotations(rc, root_scope_name, metrics, phase='download'):
+    """
+    Stream the CMDB export for the root scope into a temporary file that is
+    unique to this run, timed as phase, and yield its path.  The file is
+    removed again when the block exits.
+    """
+    fd, file_path = tempfile.mkstemp(prefix='annotations_', suffix='.csv')
+    os.close(fd)
+    try:
+        with metrics.phase(phase):
+            download_annotations(rc, root_scope_name, file_path)
+        yield file_path
+    finally:
+        os.remove(file_path)
+
+
+def read_table(file_path, columns=None):
+    """
+    Read an annotation file with every value as text and blanks as empty
+    strings, so values compare exactly as they are written.
+    """
+    try:
+        df = pd.read_csv(file_path, dtype=str, keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame(columns=columns or ['IP'], dtype=str)
+    if 'IP' not in df.columns:
+        raise Exception('No IP column in {}'.format(file_path))
+    df['IP'] = df['IP'].str.strip()
+    return df
+
+
+def row_hashes(df):
+    # With no value columns every row hashes alike, so only keys are compared
+    if len(df.columns) == 0:
+        return np.zeros(len(df), dtype=np.uint64)
+    return pd.util.hash_pandas_object(df, index=False).values
+
+
+def key_index(df, key):
+    if len(key) == 1:
+        return pd.Index(df[key[0]])
+    return pd.MultiIndex.from_frame(df[key])
+
+
+def diff_annotations(local, remote, key, columns=None):
+    """
+    Compare the local annotation table with the export, both with unique
+    keys, on columns (every local column but the key by default).  Returns
+    the local rows with a new key, the local rows that changed and the keys
+    to delete.
+    """
+    if columns is None:
+        columns = [x for x in local.columns if x not in key]
+    remote = remote.reindex(columns=key + columns, fill_value='')
+    local_keys = key_index(local, key)
+    remote_keys = key_index(remote, key)
+    # Keys are looked up in a hash table rather than sorted and joined
+    position = remote_keys.get_indexer(local_keys)
+    added = position < 0
+    changed = ~added
+    changed[changed] = (row_hashes(local[columns])[changed] !=
+                        row_hashes(remote[columns])[position[changed]])
+    deleted = local_keys.get_indexer(remote_keys) < 0
+    return (local[added].reset_index(drop=True),
+            local[changed].reset_index(drop=True),
+            remote.loc[deleted, key].reset_index(drop=True))
+
+
+def upload_rows(rc, root_scope_name, rows, operation, batch_size=5000,
+                max_in_flight=4):
+    """
+    Upload rows to the CMDB of the root scope with operation ('add' or
+    'delete') in batches of at most batch_size rows, max_in_flight at a
+    time.  Returns the errors of the batches that failed.
+    """
+    def upload(start):
+        batch = rows.iloc[start:start + batch_size]
+        fd, file_path = tempfile.mkstemp(prefix='cmdb_{}_'.format(operation),
+                                         suffix='.csv')
+        os.close(fd)
+        try:
+            batch.to_csv(file_path, index=False)
+            resp = rc.upload(file_path, '/assets/cmdb/upload/' + root_scope_name,
+                             params=[MultiPartOption(key='X-Tetration-Oper',
+                                                     val=operation)],
+                             timeout=UPLOAD_TIMEOUT)
+        finally:
+            os.remove(file_path)
+        if resp.status_code != 200:
+            return '[ERROR] uploading {} rows {}-{}: HTTP {} {}'.format(
+                operation, start + 1, start + len(batch), resp.status_code, resp.text)
+        print('[UPLOADED] {} rows {}-{}'.format(operation, start + 1, start + len(batch)))
+
+    errors = []
+    if len(rows) == 0:
+        return errors
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = [executor.submit(upload, start)
+                   for start in range(0, len(rows), batch_size)]
+        for future in as_completed(futures):
+            try:
+                error = future.result()
+            except Exception as e:
+                error = '[ERROR] uploading {} rows: {}'.format(operation, e)
+            if error:
+                print(error)
+                errors.append(error)
+    return errors
+
+
+def sync_annotations(rc, root_scope_name, file_path, batch_size=5000,
+                     max_in_flight=4, metrics=None):
+    """
+    Bring the CMDB export of the root scope in line with the local
+    annotation file by uploading only the rows that differ.  Returns the
+    errors of the failed batches.
+    """
+    metrics = metrics or RunMetrics('scope_builder', root_scope_name)
+    with downloaded_annotations(rc, root_scope_name, metrics,
+                                'sync_download') as export_path:
+        with metrics.phase('sync_diff'):
+            local = read_table(file_path)
+            key = ['VRF', 'IP'] if 'VRF' in local.columns else ['IP']
+            duplicates = local.duplicated(key, keep='last')
+            if duplicates.any():
+                print('Keeping the last of {} rows with a duplicate {} in {}.'.format(
+                    int(duplicates.sum()), '/'.join(key), file_path))
+                local = local[~duplicates].reset_index(drop=True)
+            remote = read_table(export_path, list(local.columns))
+            remote = remote.reindex(columns=key + [x for x in remote.columns if x not in key],
+                                    fill_value='')
+            remote = remote[~remote.duplicated(key, keep='last')]
+            added, changed, deletes = diff_annotations(local, remote, key)
+
+    print('Annotation changes for {}: {} added, {} changed, {} deleted of {} rows.'.format(
+        root_scope_name, len(added), len(changed), len(deletes), len(local)))
+    metrics.count('annotations_added', len(added))
+    metrics.count('annotations_changed', len(changed))
+    metrics.count('annotations_deleted', len(deletes))
+
+    with metrics.phase('sync_upload'):
+        errors = upload_rows(rc, root_scope_name, pd.concat([added, changed]),
+                             'add', batch_size, max_in_flight)
+        errors += upload_rows(rc, root_scope_name, deletes, 'delete', batch_size,
+                              max_in_flight)
+    return errors
@@ -0,0 +1,490 @@
+"""
+Local stand-in for the parts of the Tetration OpenAPI used by scope_builder.py
+and clean.py, for load and latency testing without a live cluster.
+
+The server keeps scopes, application workspaces, inventory filters, agent
+config intents and CMDB annotations in memory, and applies CMDB uploads
+(add, delete and overwrite) to the export it serves.  Every request can be
+slowed down by a fixed latency, failed at a configurable rate with a 503 and
+throttled with a 429 once it exceeds the configured requests per second.
+Request signatures are not checked.
+"""
+
+import argparse
+import csv
+import email.parser
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote
+
+API_PREFIX = '/openapi/v1'
+
+
+class FakeTetration(object):
+    """
+    In-memory cluster state plus the fault injection settings.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.scopes = {}
+        self.applications = {}
+        self.filters = {}
+        self.intents = {}
+        self.annotations = {}
+        # Parsed annotations of the tenants with uploads: (header, {key: row})
+        self.cmdb = {}
+        self.uploads = Counter()
+        self.requests = Counter()
+        self.statuses = Counter()
+        self._tokens = float(rate_limit)
+        self._refilled = time.time()
+
+    # -------------------------------------------------------------------------
+    # Seeding
+
+    def add_tenant(self, name, vrf_id=1, annotations=None):
+        """
+        Create a root scope for a tenant and optionally attach the CSV export
+        served by /assets/cmdb/download/<name>.  Returns the root scope id.
+        """
+        with self.lock:
+            scope_id = self._new_id()
+            query = {'type': 'eq', 'field': 'vrf_id', 'value': vrf_id}
+            self.scopes[scope_id] = {
+                'id': scope_id,
+                'short_name': name,
+                'name': name,
+                'description': None,
+                'short_query': query,
+                'query': query,
+                'vrf_id': vrf_id,
+                'parent_app_scope_id': None,
+                'root_app_scope_id': scope_id,
+                'child_app_scope_ids': [],
+                'updated_at': int(time.time()),
+            }
+        if annotations is not None:
+            self.set_annotations(name, annotations)
+        return scope_id
+
+    def set_annotations(self, root_scope_name, csv_text):
+        with self.lock:
+            self.annotations[root_scope_name] = csv_text
+            self.cmdb.pop(root_scope_name, None)
+
+    def add_application(self, app_scope_id, name=None, primary=True,
+                        enforcement_enabled=False):
+        with self.lock:
+            app_id = self._new_id()
+            self.applications[app_id] = {
+                'id': app_id,
+                'name': name or 'app-{}'.format(app_id[:8]),
+                'app_scope_id': app_scope_id,
+                'primary': primary,
+                'enforcement_enabled': enforcement_enabled,
+            }
+            return app_id
+
+    def add_filter(self, vrf_id, name=None):
+        with self.lock:
+            filter_id = self._new_id()
+            self.filters[filter_id] = {
+                'id': filter_id,
+                'name': name or 'filter-{}'.format(filter_id[:8]),
+                'query': {'type': 'and', 'filters': [
+                    {'type': 'eq', 'field': 'vrf_id', 'value': vrf_id},
+                    {'type': 'subnet', 'field': 'ip', 'value': '10.0.0.0/8'}]},
+            }
+            return filter_id
+
+    def add_intent(self, inventory_filter_id):
+        with self.lock:
+            intent_id = self._new_id()
+            self.intents[intent_id] = {
+                'id': intent_id,
+                'inventory_filter_id': inventory_filter_id,
+                'agent_config_profile_id': self._new_id(),
+            }
+            return intent_id
+
+    def tenant_scopes(self, root_scope_id):
+        with self.lock:
+            return [x for x in self.scopes.values()
+                    if x['root_app_scope_id'] == root_scope_id]
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests.clear()
+            self.statuses.clear()
+
+    def counters(self):
+        with self.lock:
+            return {'requests': dict(self.requests),
+                    'statuses': dict((str(k), v) for k, v in self.statuses.items()),
+                    'total': sum(self.requests.values())}
+
+    def _new_id(self):
+        return uuid.uuid4().hex[:24]
+
+    # -------------------------------------------------------------------------
+    # Fault injection
+
+    def throttled(self):
+        """
+        Token bucket of rate_limit requests per second with a one second burst.
+        """
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            now = time.time()
+            self._tokens = min(float(self.rate_limit), self._tokens +
+                               (now - self._refilled) * self.rate_limit)
+            self._refilled = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+    # -------------------------------------------------------------------------
+    # Endpoints.  Each returns (status, body) where body is JSON-serializable,
+    # or a str for CSV downloads.
+
+    def list_scopes(self, body):
+        with self.lock:
+            scopes = list(self.scopes.values())
+            if body.get('root_app_scope_id'):
+                scopes = [x for x in scopes if
+                          x['root_app_scope_id'] == body['root_app_scope_id']]
+            return 200, scopes
+
+    def get_scope(self, body, scope_id):
+        with self.lock:
+            if scope_id not in self.scopes:
+                return 404, {'error': 'scope not found'}
+            return 200, self.scopes[scope_id]
+
+    def create_scope(self, body):
+        with self.lock:
+            parent = self.scopes.get(body.get('parent_app_scope_id'))
+            if parent is None:
+                return 422, {'error': 'parent scope not found'}
+            name = parent['name'] + ':' + body['short_name']
+            if any(x['name'].lower() == name.lower() for x in
+                   (self.scopes[c] for c in parent['child_app_scope_ids'])):
+                return 422, {'error': 'scope {} already exists'.format(name)}
+            scope_id = self._new_id()
+            scope = {
+                'id': scope_id,
+                'short_name': body['short_name'],
+                'name': name,
+                'description': body.get('description'),
+                'short_query': body['short_query'],
+                'query': {'type': 'and', 'filters': [
+                    parent['query'], body['short_query']]},
+                'vrf_id': parent['vrf_id'],
+                'parent_app_scope_id': parent['id'],
+                'root_app_scope_id': parent['root_app_scope_id'],
+                'child_app_scope_ids': [],
+                'updated_at': int(time.time()),
+            }
+            self.scopes[scope_id] = scope
+            parent['child_app_scope_ids'].append(scope_id)
+            return 200, scope
+
+    def delete_scope(self, body, scope_id):
+        with self.lock:
+            scope = self.scopes.get(scope_id)
+            if scope is None:
+                return 404, {'error': 'scope not found'}
+            if scope['child_app_scope_ids']:
+                return 422, {'error': 'scope has child scopes'}
+            if any(x['app_scope_id'] == scope_id for x in self.applications.values()):
+                return 422, {'error': 'scope has application workspaces'}
+            del self.scopes[scope_id]
+            parent = self.scopes.get(scope['parent_app_scope_id'])
+            if parent is not None:
+                parent['child_app_scope_ids'].remove(scope_id)
+            return 200, {}
+
+    def list_applications(self, body):
+        with self.lock:
+            return 200, list(self.applications.values())
+
+    def disable_enforce(self, body, app_id):
+        return self._update_application(app_id, {'enforcement_enabled': False})
+
+    def enable_enforce(self, body, app_id):
+        return self._update_application(app_id, {'enforcement_enabled': True})
+
+    def update_application(self, body, app_id):
+        changes = {}
+        if 'primary' in body:
+            changes['primary'] = str(body['primary']).lower() == 'true'
+        return self._update_application(app_id, changes)
+
+    def _update_application(self, app_id, changes):
+        with self.lock:
+            if app_id not in self.applications:
+                return 404, {'error': 'application not found'}
+            self.applications[app_id].update(changes)
+            return 200, self.applications[app_id]
+
+    def delete_application(self, body, app_id):
+        with self.lock:
+            app = self.applications.get(app_id)
+            if app is None:
+                return 404, {'error': 'application not found'}
+            if app['enforcement_enabled'] or app['primary']:
+                return 422, {'error': 'application is enforcing or primary'}
+            del self.applications[app_id]
+            return 200, {}
+
+    def list_filters(self, body):
+        with self.lock:
+            return 200, list(self.filters.values())
+
+    def delete_filter(self, body, filter_id):
+        with self.lock:
+            if filter_id not in self.filters:
+                return 404, {'error': 'filter not found'}
+            if any(x['inventory_filter_id'] == filter_id for x in self.intents.values()):
+                return 422, {'error': 'filter is used by an intent'}
+            del self.filters[filter_id]
+            return 200, {}
+
+    def list_intents(self, body):
+        with self.lock:
+            return 200, list(self.intents.values())
+
+    def delete_intent(self, body, intent_id):
+        with self.lock:
+            if intent_id not in self.intents:
+                return 404, {'error': 'intent not found'}
+            del self.intents[intent_id]
+            return 200, {}
+
+    def download_annotations(self, body, root_scope_name):
+        with self.lock:
+            if root_scope_name not in self.annotations:
+                return 404, {'error': 'no annotations for {}'.format(root_scope_name)}
+            if self.annotations[root_scope_name] is None:
+                # Serialized again only after uploads changed it
+                header, rows = self.cmdb[root_scope_name]
+                output = io.StringIO()
+                writer = csv.DictWriter(output, header, restval='', lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(rows.values())
+                self.annotations[root_scope_name] = output.getvalue()
+            return 200, self.annotations[root_scope_name]
+
+    def upload_annotations(self, body, root_scope_name):
+        operation = body.get('X-Tetration-Oper')
+        if operation not in ('add', 'delete', 'overwrite'):
+            return 400, {'error': 'unknown X-Tetration-Oper {}'.format(operation)}
+        reader = csv.DictReader(io.StringIO(body.get('file', '')))
+        if 'IP' not in (reader.fieldnames or []):
+            return 400, {'error': 'missing IP column'}
+        key = ['VRF', 'IP'] if 'VRF' in reader.fieldnames else ['IP']
+        uploaded = list(reader)
+        with self.lock:
+            if root_scope_name not in self.cmdb or operation == 'overwrite':
+                rows = {}
+                header = list(reader.fieldnames)
+                if operation != 'overwrite':
+                    existing = csv.DictReader(io.StringIO(
+                        self.annotations.get(root_scope_name) or ''))
+                    header = list(existing.fieldnames or header)
+                    rows = dict((tuple(row.get(x, '') for x in key), row)
+                                for row in existing)
+                self.cmdb[root_scope_name] = (header, rows)
+            header, rows = self.cmdb[root_scope_name]
+            for row in uploaded:
+                row_key = tuple(row.get(x, '') for x in key)
+                if operation == 'delete':
+                    rows.pop(row_key, None)
+                else:
+                    rows.setdefault(row_key, {}).update(row)
+            if operation != 'delete':
+                header.extend(x for x in reader.fieldnames if x not in header)
+            self.annotations[root_scope_name] = None
+            self.uploads[operation] += len(uploaded)
+        return 200, {'operation': operation, 'rows': len(uploaded)}
+
+
+# (method, path pattern, FakeTetration method, endpoint label for counters)
+ROUTES = [
+    ('GET', r'/app_scopes/?', 'list_scopes', 'GET /app_scopes'),
+    ('GET', r'/app_scopes/([^/]+)', 'get_scope', 'GET /app_scopes/{id}'),
+    ('POST', r'/app_scopes/?', 'create_scope', 'POST /app_scopes'),
+    ('DELETE', r'/app_scopes/([^/]+)', 'delete_scope', 'DELETE /app_scopes/{id}'),
+    ('GET', r'/applications/?', 'list_applications', 'GET /applications'),
+    ('POST', r'/applications/([^/]+)/disable_enforce', 'disable_enforce',
+     'POST /applications/{id}/disable_enforce'),
+    ('POST', r'/applications/([^/]+)/enable_enforce', 'enable_enforce',
+     'POST /applications/{id}/enable_enforce'),
+    ('PUT', r'/applications/([^/]+)', 'update_application', 'PUT /applications/{id}'),
+    ('DELETE', r'/applications/([^/]+)', 'delete_application',
+     'DELETE /applications/{id}'),
+    ('GET', r'/filters/inventories/?', 'list_filters', 'GET /filters/inventories'),
+    ('DELETE', r'/filters/inventories/([^/]+)', 'delete_filter',
+     'DELETE /filters/inventories/{id}'),
+    ('GET', r'/inventory_config/intents/?', 'list_intents',
+     'GET /inventory_config/intents'),
+    ('DELETE', r'/inventory_config/intents/([^/]+)', 'delete_intent',
+     'DELETE /inventory_config/intents/{id}'),
+    ('GET', r'/assets/cmdb/download/(.+)', 'download_annotations',
+     'GET /assets/cmdb/download/{root}'),
+    ('POST', r'/assets/cmdb/upload/(.+)', 'upload_annotations',
+     'POST /assets/cmdb/upload/{root}'),
+]
+ROUTES = [(method, re.compile('^' + API_PREFIX + pattern + '$'), handler, label)
+          for method, pattern, handler, label in ROUTES]
+
+
+def parse_multipart(content_type, raw_body):
+    """
+    Fields of a multipart/form-data body, such as a CMDB upload, as text.
+    """
+    message = email.parser.BytesParser().parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + raw_body)
+    return dict((part.get_param('name', header='content-disposition'),
+                 part.get_payload(decode=True).decode('utf-8'))
+                for part in message.get_payload())
+
+
+class FakeTetrationHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self, method):
+        cluster = self.server.cluster
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+        path, _, query = self.path.partition('?')
+        path = unquote(path)
+
+        for route_method, pattern, handler, label in ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(method + ' ' + path, 404, {'error': 'no such endpoint'})
+
+        if cluster.throttled():
+            return self.respond(label, 429, {'error': 'rate limit exceeded'})
+        if cluster.latency:
+            time.sleep(cluster.latency)
+        if cluster.error_rate and random.random() < cluster.error_rate:
+            return self.respond(label, 503, {'error': 'injected failure'})
+        content_type = self.headers.get('Content-Type', '')
+        try:
+            if content_type.startswith('multipart/form-data'):
+                body = parse_multipart(content_type, raw_body)
+            else:
+                body = json.loads(raw_body.decode('utf-8')) if raw_body else {}
+        except ValueError:
+            return self.respond(label, 400, {'error': 'invalid JSON body'})
+        # Query string parameters are passed to GET handlers as the body
+        if method == 'GET' and query:
+            body = dict(parse_qsl(query))
+        status, payload = getattr(cluster, handler)(body, *match.groups())
+        self.respond(label, status, payload)
+
+    def respond(self, label, status, payload):
+        cluster = self.server.cluster
+        # Serialize under the lock so concurrent writers cannot change the
+        # scopes being listed
+        with cluster.lock:
+            cluster.requests[label] += 1
+            cluster.statuses[status] += 1
+            if isinstance(payload, str):
+                data = payload.encode('utf-8')
+                content_type = 'text/csv'
+            else:
+                data = json.dumps(payload).encode('utf-8')
+                content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def start_server(cluster, host='127.0.0.1', port=0):
+    """
+    Serve the cluster on a background thread.  Returns the server and the
+    base URL to hand to RestClient.
+    """
+    server = ThreadingHTTPServer((host, port), FakeTetrationHandler)
+    server.daemon_threads = True
+    server.cluster = cluster
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://{}:{}'.format(host, server.server_address[1])
+
+
+def main():
+    """
+    Main execution routine
+    """
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Tetration OpenAPI endpoints used by the scope builder and cleaner.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', default=8080, type=int, help='Port to listen on')
+    parser.add_argument('--tenant', default='Default', help='Root scope to create')
+    parser.add_argument('--vrf_id', default=1, type=int, help='VRF id of the root scope')
+    parser.add_argument('--annotations', default=None,
+                        help='CSV file served as the CMDB export of the root scope')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='Seconds added to every request')
+    parser.add_argument('--error_rate', default=0.0, type=float,
+                        help='Fraction of requests failed with a 503')
+    parser.add_argument('--rate_limit', default=0, type=int,
+                        help='Requests per second before answering 429 (0 disables)')
+    args = parser.parse_args()
+
+    cluster = FakeTetration(latency=args.latency, error_rate=args.error_rate,
+                            rate_limit=args.rate_limit)
+    annotations = None
+    if args.annotations:
+        with open(args.annotations) as f:
+            annotations = f.read()
+    cluster.add_tenant(args.tenant, vrf_id=args.vrf_id, annotations=annotations)
+    server, url = start_server(cluster, host=args.host, port=args.port)
+    print('Fake Tetration API for tenant "{}" listening on {}'.format(args.tenant, url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Synthetic annotation files for benchmarking scope_builder.py at sizes no
+real sample covers.
+
+A generated file looks like a CMDB export: an IP column and one column per
+tier.  Subnet rows come first, nested at every mask length of --prefixes (and
+of --ipv6_prefixes for the IPv6 share of the rows), each tagging some of the
+upper tiers and leaving the rest to be inherited.  Host rows follow, most of
+them inside a subnet, tagging a random subset of the tiers.  Tier values are
+drawn from a vocabulary of --cardinalities distinct values per column, with
+a long-tailed frequency, lengths between --min_length and --max_length, and
+a share of values over the 40 character limit or with invalid characters so
+the abbreviation checks have work to do.
+
+The same arguments and --seed always produce the same file.  Rows are
+written --chunk_size at a time, so 10M row files only need the addresses in
+memory.
+"""
+
+import argparse
+import ipaddress
+import string
+
+import numpy as np
+import pandas as pd
+
+from scope_builder import INVALID_CHARS, MAX_VALUE_LENGTH
+
+FILLER = np.array(list(string.ascii_letters + '  '))
+# 2001:db8::/32, the IPv6 documentation block
+V6_BASE = 0x20010db8
+
+
+def parse_count(text):
+    """
+    Row count from text such as 10000, 100k or 1.5M.
+    """
+    text = str(text).strip().lower()
+    scale = {'k': 10 ** 3, 'm': 10 ** 6}.get(text[-1:], 1)
+    if scale > 1:
+        text = text[:-1]
+    return int(float(text) * scale)
+
+
+def vocabulary(rng, column, cardinality, min_length, max_length,
+               long_fraction=0.05, invalid_fraction=0.01):
+    """
+    Distinct values of one tier column.  Every value ends in its number, so
+    values never collide, and is padded with random letters to its length.
+    """
+    lengths = rng.integers(min_length, max_length + 1, cardinality)
+    long = rng.random(cardinality) < long_fraction
+    lengths[long] = rng.integers(MAX_VALUE_LENGTH + 1, 2 * MAX_VALUE_LENGTH + 1,
+                                 int(long.sum()))
+    invalid = rng.random(cardinality) < invalid_fraction
+    stem = ''.join(x[0] for x in column.split()) or 'V'
+    values = []
+    for i in range(cardinality):
+        suffix = ' {}{}'.format(stem, i)
+        filler = ''.join(rng.choice(FILLER, max(lengths[i] - len(suffix), 1)))
+        value = (filler.strip() or 'x') + suffix
+        if invalid[i]:
+            position = rng.integers(1, len(value))
+            value = value[:position] + INVALID_CHARS[0] + value[position:]
+        values.append(value)
+    return np.array(values, dtype=object)
+
+
+def draw(rng, values, count, skew=1.0):
+    """
+    count values with a long tail: the k-th value is drawn with a weight of
+    1 / k ** skew.
+    """
+    weights = 1.0 / np.arange(1, len(values) + 1) ** skew
+    return values[rng.choice(len(values), count, p=weights / weights.sum())]
+
+
+def nested_subnets(rng, count, prefixes, bits, base=0, base_prefix=0,
+                   first=None):
+    """
+    About count subnets nested level by level: each level has twice as many
+    subnets as the one above it, and each subnet is a random block of a
+    subnet one level up.  The first level is cut from base/base_prefix, from
+    the blocks numbered first[0] to first[1] - 1 when first is given.
+    Returns (hi, lo, prefix, level) arrays, hi and lo being the upper and
+    lower 64 bits of the network.
+    """
+    weights = 2.0 ** np.arange(len(prefixes))
+    counts = np.maximum(np.round(count * weights / weights.sum()), 1).astype(np.int64)
+    nets = []
+    parents = np.array([int(base)], dtype=object)
+    parent_prefix = base_prefix
+    for level, prefix in enumerate(prefixes):
+        blocks = 1 << (prefix - parent_prefix)
+        number = min(int(counts[level]), blocks * len(parents))
+        chosen = rng.choice(len(parents), number)
+        low, high = first if level == 0 and first else (0, min(blocks, 1 << 62))
+        offsets = rng.integers(low, high, number)
+        level_nets = sorted(set(int(parents[c]) | (int(o) << (bits - prefix))
+                                for c, o in zip(chosen, offsets)))
+        nets += [(n, prefix, level) for n in level_nets]
+        parents = np.array(level_nets, dtype=object)
+        parent_prefix = prefix
+    hi = np.array([n >> 64 for n, _, _ in nets], dtype=np.uint64)
+    lo = np.array([n & 0xFFFFFFFFFFFFFFFF for n, _, _ in nets], dtype=np.uint64)
+    return (hi, lo, np.array([p for _, p, _ in nets], dtype=np.int64),
+            np.array([l for _, _, l in nets], dtype=np.int64))
+
+
+def hosts(rng, count, subnets, bits, covered_fraction, random_address):
+    """
+    count distinct host addresses as (hi, lo), covered_fraction of them in a
+    random subnet and the rest wherever random_address(n), which returns n
+    (hi, lo) addresses, puts them.
+    """
+    sub_hi, sub_lo, sub_prefix, _ = subnets
+    found = pd.DataFrame({'hi': np.empty(0, dtype=np.uint64),
+                          'lo': np.empty(0, dtype=np.uint64)})
+    while len(found) < count:
+        batch = int((count - len(found)) * 1.1) + 16
+        hi, lo = random_address(batch)
+        covered = (rng.random(batch) < covered_fraction) & (len(sub_lo) > 0)
+        parent = rng.integers(0, max(len(sub_lo), 1), batch)[covered]
+        host_bits = bits - sub_prefix[parent]
+        # Keep the random bits below the subnet prefix, the network above it
+        mask_lo = np.where(host_bits >= 64, np.uint64(0xFFFFFFFFFFFFFFFF),
+                           (np.uint64(1) << np.minimum(host_bits, 63).astype(np.uint64)) -
+                           np.uint64(1))
+        mask_hi = np.where(host_bits > 64,
+                           (np.uint64(1) << np.clip(host_bits - 64, 0, 63).astype(np.uint64)) -
+                           np.uint64(1), np.uint64(0))
+        lo[covered] = sub_lo[parent] | (lo[covered] & mask_lo)
+        hi[covered] = sub_hi[parent] | (hi[covered] & mask_hi)
+        found = pd.concat([found, pd.DataFrame({'hi': hi, 'lo': lo})],
+                          ignore_index=True).drop_duplicates(ignore_index=True)
+    found = found.iloc[rng.permutation(len(found))[:count]]
+    return found['hi'].values, found['lo'].values
+
+
+def format_ips(version, hi, lo, prefix=None):
+    """
+    Text of each address, with /prefix when prefix is given.
+    """
+    text = np.empty(len(lo), dtype=object)
+    v4 = version == 4
+    octets = [((lo[v4] >> np.uint64(shift)) & np.uint64(255)).astype(str)
+              for shift in (24, 16, 8, 0)]
+    if v4.any():
+        text[v4] = pd.Series(octets[0]).str.cat(octets[1:], sep='.').to_numpy(dtype=object)
+    for i in np.flatnonzero(~v4):
+        text[i] = str(ipaddress.IPv6Address((int(hi[i]) << 64) | int(lo[i])))
+    if prefix is not None:
+        text = pd.Series(text).str.cat(pd.Series(prefix).astype(str),
+                                       sep='/').to_numpy(dtype=object)
+    return text
+
+
+def tag_rows(rng, vocabularies, count, allowed, tag_fraction):
+    """
+    Tier values of count rows: each allowed column is tagged with
+    tag_fraction probability and every row gets at least one value.
+    """
+    allowed = np.broadcast_to(allowed, (count, len(vocabularies)))
+    tagged = (rng.random((count, len(vocabularies))) < tag_fraction) & allowed
+    last = np.where(allowed, np.arange(len(vocabularies)), -1).max(axis=1)
+    empty = ~tagged.any(axis=1)
+    tagged[np.flatnonzero(empty), last[empty]] = True
+    columns = []
+    for j, values in enumerate(vocabularies):
+        column = np.full(count, '', dtype=object)
+        column[tagged[:, j]] = draw(rng, values, int(tagged[:, j].sum()))
+        columns.append(column)
+    return columns
+
+
+def generate(file_path, rows, columns, cardinalities, prefixes=(8, 12, 16, 20, 24, 28),
+             ipv6_prefixes=(32, 40, 48, 56, 64), subnet_fraction=0.02,
+             ipv6_fraction=0.05, covered_fraction=0.9, subnet_tag_fraction=0.6,
+             host_tag_fraction=0.5, min_length=4, max_length=24,
+             long_fraction=0.05, invalid_fraction=0.01, seed=0,
+             chunk_size=1000000):
+    """
+    Write a synthetic annotation file of rows rows to file_path.  Returns
+    the numbers of subnet and host rows.
+    """
+    rng = np.random.default_rng(seed)
+    vocabularies = [vocabulary(rng, column, cardinality, min_length, max_length,
+                               long_fraction, invalid_fraction)
+                    for column, cardinality in zip(columns, cardinalities)]
+    subnet_rows = int(rows * subnet_fraction)
+    v6_subnets = int(subnet_rows * ipv6_fraction)
+    # IPv4 subnets start in the unicast /8s from 1 to 223, IPv6 ones in the
+    # 2001:db8::/32 documentation block
+    v4 = nested_subnets(rng, subnet_rows - v6_subnets, list(prefixes), 32,
+                        first=(1 << prefixes[0] - 8, 224 << prefixes[0] - 8))
+    v6 = nested_subnets(rng, v6_subnets, list(ipv6_prefixes), 128,
+                        V6_BASE << 96, 32) if v6_subnets else \
+        tuple(np.empty(0, dtype=t) for t in (np.uint64, np.uint64, np.int64, np.int64))
+    subnet_count = len(v4[1]) + len(v6[1])
+    host_count = max(rows - subnet_count, 0)
+    v6_hosts = int(host_count * ipv6_fraction)
+
+    with open(file_path, 'w', newline='') as f:
+        f.write(','.join(['IP'] + list(columns)) + '\n')
+        # Subnets tag the tiers their depth reaches down to
+        for version, (hi, lo, prefix, level), depth in (
+                (4, v4, len(prefixes)), (6, v6, len(ipv6_prefixes))):
+            if len(lo) == 0:
+                continue
+            reach = (level + 1) * len(columns) // depth
+            allowed = np.arange(len(columns))[None, :] < np.maximum(reach, 1)[:, None]
+            frame = pd.DataFrame({'IP': format_ips(np.full(len(lo), version), hi, lo,
+                                                   prefix)})
+            for column, values in zip(columns, tag_rows(rng, vocabularies, len(lo),
+                                                        allowed, subnet_tag_fraction)):
+                frame[column] = values
+            frame.to_csv(f, header=False, index=False)
+
+        v4_hi, v4_lo = hosts(rng, host_count - v6_hosts, v4, 32, covered_fraction,
+                             lambda n: (np.zeros(n, dtype=np.uint64),
+                                        rng.integers(1 << 24, 224 << 24, n).astype(np.uint64)))
+        v6_hi, v6_lo = hosts(rng, v6_hosts, v6, 128, covered_fraction,
+                             lambda n: ((np.uint64(V6_BASE << 32) |
+                                         rng.integers(0, 1 << 32, n).astype(np.uint64)),
+                                        rng.integers(0, 1 << 63, n).astype(np.uint64)))
+        version = np.r_[np.full(len(v4_lo), 4), np.full(len(v6_lo), 6)]
+        hi, lo = np.r_[v4_hi, v6_hi], np.r_[v4_lo, v6_lo]
+        order = rng.permutation(len(lo))
+        allowed = np.ones((1, len(columns)), dtype=bool)
+        for start in range(0, len(order), chunk_size):
+            chunk = order[start:start + chunk_size]
+            frame = pd.DataFrame({'IP': format_ips(version[chunk], hi[chunk], lo[chunk])})
+            for column, values in zip(columns, tag_rows(rng, vocabularies, len(chunk),
+                                                        allowed, host_tag_fraction)):
+                frame[column] = values
+            frame.to_csv(f, header=False, index=False)
+    return subnet_count, len(lo)
+
+
+def main():
+    """
+    Main execution routine
+    """
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic annotation file for benchmarking scope_builder.py.')
+    parser.add_argument('--rows', default='100k',
+                        help='Rows to write (ex: 10k, 100k, 1M, 10M)')
+    parser.add_argument('--output', default='annotations_{rows}.csv',
+                        help='File to write; {rows} is replaced by --rows')
+    parser.add_argument('--columns', default='Org,Region,Zone,App,Env',
+                        help='Comma delimited tier columns')
+    parser.add_argument('--cardinalities', default='5,20,200,2000,6',
+                        help='Comma delimited distinct values of each tier column')
+    parser.add_argument('--prefixes', default='8,12,16,20,24,28',
+                        help='Comma delimited IPv4 mask lengths of the nested subnet levels')
+    parser.add_argument('--ipv6_prefixes', default='32,40,48,56,64',
+                        help='Comma delimited IPv6 mask lengths of the nested subnet levels')
+    parser.add_argument('--subnet_fraction', default=0.02, type=float,
+                        help='Share of the rows that are subnets')
+    parser.add_argument('--ipv6_fraction', default=0.05, type=float,
+                        help='Share of the subnet and host rows that are IPv6')
+    parser.add_argument('--covered_fraction', default=0.9, type=float,
+                        help='Share of the hosts inside a subnet')
+    parser.add_argument('--subnet_tag_fraction', default=0.6, type=float,
+                        help='Chance a subnet row tags each tier its depth reaches')
+    parser.add_argument('--host_tag_fraction', default=0.5, type=float,
+                        help='Chance a host row tags each tier')
+    parser.add_argument('--min_length', default=4, type=int, help='Shortest tier value')
+    parser.add_argument('--max_length', default=24, type=int,
+                        help='Longest tier value, apart from the long ones')
+    parser.add_argument('--long_fraction', default=0.05, type=float,
+                        help='Share of the tier values over the 40 character limit')
+    parser.add_argument('--invalid_fraction', default=0.01, type=float,
+                        help='Share of the tier values with an invalid character')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed')
+    parser.add_argument('--chunk_size', default=1000000, type=int,
+                        help='Host rows formatted and written at a time')
+    args = parser.parse_args()
+
+    columns = [x.strip() for x in args.columns.split(',') if x.strip()]
+    cardinalities = [int(x) for x in args.cardinalities.split(',')]
+    if len(cardinalities) != len(columns):
+        parser.error('--cardinalities needs one value per column')
+    output = args.output.format(rows=args.rows)
+    subnets, host_rows = generate(
+        output, parse_count(args.rows), columns, cardinalities,
+        prefixes=[int(x) for x in args.prefixes.split(',')],
+        ipv6_prefixes=[int(x) for x in args.ipv6_prefixes.split(',')],
+        subnet_fraction=args.subnet_fraction, ipv6_fraction=args.ipv6_fraction,
+        covered_fraction=args.covered_fraction,
+        subnet_tag_fraction=args.subnet_tag_fraction,
+        host_tag_fraction=args.host_tag_fraction, min_length=args.min_length,
+        max_length=args.max_length, long_fraction=args.long_fraction,
+        invalid_fraction=args.invalid_fraction, seed=args.seed,
+        chunk_size=args.chunk_size)
+    print('Wrote {} subnet and {} host rows to {}'.format(subnets, host_rows, output))
+
+
+if __name__ == '__main__':
+    main()
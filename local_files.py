@@ -0,0 +1,65 @@
+"""
+Local file helpers shared by scope_builder.py and its caches, journals and
+metrics.
+
+Files other processes may read at any time (the tenant configuration, the
+metrics files, cached tables) are written aside and renamed over the old
+file, so a reader never sees a partial file.  The new file keeps the mode of
+the file it replaces, or the mode a plain open() would have given it.
+"""
+
+import contextlib
+import hashlib
+import os
+import re
+import stat
+import tempfile
+
+
+# The umask can only be read by setting it, which would briefly change it
+# for every thread of the process, so it is read once at import
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def safe_name(name):
+    """
+    A tenant name turned into something safe to use in a file name.  Names
+    that only differ in the characters replaced, such as "T/2" and "T_2",
+    are told apart by a short hash of the name.
+    """
+    digest = hashlib.sha256(name.encode('utf-8')).hexdigest()[:8]
+    return '{}-{}'.format(re.sub(r'[^\w.-]', '_', name), digest)
+
+
+@contextlib.contextmanager
+def atomic_path(file_path):
+    """
+    Yield a temporary path next to file_path to write the new file to.  It
+    replaces file_path when the block completes and is removed if it fails.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(
+        prefix='.{}_'.format(os.path.basename(file_path)), dir=directory)
+    os.close(fd)
+    try:
+        yield temp_path
+        try:
+            mode = stat.S_IMODE(os.stat(file_path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_umask
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_atomic(file_path, text):
+    """
+    Replace file_path with text in one step.
+    """
+    with atomic_path(file_path) as temp_path:
+        with open(temp_path, 'w') as outfile:
+            outfile.write(text)
@@ -0,0 +1,255 @@
+"""
+Run instrumentation for scope_builder.py and clean.py.
+
+RunMetrics records, for one run of a script against one tenant:
+
+* the wall time, CPU time and memory high-water mark of each phase,
+* the count, status codes and latency histogram of the API requests sent to
+  each endpoint, recorded by TetClient for every attempt including retries,
+  and
+* counts of the rows, scopes and other items the run processed.
+
+The report is written as JSON to --metrics_file and, optionally, in the
+Prometheus text format to --prometheus_file for the node_exporter textfile
+collector, so slow runs can be broken down and compared over time.
+"""
+
+import contextlib
+import json
+import re
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from local_files import write_atomic
+
+# Upper bounds in seconds of the API latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, float('inf'))
+
+# Path segments replaced so requests to different objects share an endpoint
+ENDPOINT_PATTERNS = [
+    (re.compile(r'^/assets/cmdb/(\w+)/.+'), r'/assets/cmdb/\1/{root}'),
+    (re.compile(r'/[0-9a-f]{24}(?=/|$)'), '/{id}'),
+]
+
+
+def max_rss():
+    """
+    Memory high-water mark of this process in bytes, or None where the
+    resource module is not available.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes everywhere but on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def endpoint_name(uri_path):
+    """
+    Endpoint of a request URI: without the API prefix and query string, and
+    with object ids replaced by {id}.
+    """
+    path = uri_path.split('?')[0]
+    if path.startswith('/openapi/v1'):
+        path = path[len('/openapi/v1'):]
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return path.rstrip('/') or '/'
+
+
+class RunMetrics(object):
+    """
+    Phase timings, API request statistics and item counts of one run.  Safe
+    to share between worker threads.
+    """
+
+    def __init__(self, script, tenant=None):
+        self.script = script
+        self.tenant = tenant
+        self.started = time.time()
+        self.wall_time = None
+        self.phases = {}
+        self.requests = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time the block as the named phase.  A phase entered more than once
+        adds up.
+        """
+        wall, cpu, rss = time.time(), time.process_time(), max_rss()
+        try:
+            yield
+        finally:
+            wall = time.time() - wall
+            cpu = time.process_time() - cpu
+            peak = max_rss()
+            with self._lock:
+                phase = self.phases.setdefault(name, {
+                    'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                    'max_rss': None, 'rss_growth': None})
+                phase['calls'] += 1
+                phase['wall_time'] += wall
+                phase['cpu_time'] += cpu
+                if peak is not None:
+                    # The high-water mark only grows, so the growth shows
+                    # which phase raised the peak memory of the run
+                    phase['max_rss'] = peak
+                    phase['rss_growth'] = (phase['rss_growth'] or 0) + peak - rss
+            print('[PHASE] {}: {:.3f}s wall, {:.3f}s CPU'.format(name, wall, cpu))
+
+    def request(self, method, uri_path, status, seconds):
+        """
+        Record one API request attempt.  status is the HTTP status code, or
+        'error' when no response came back.
+        """
+        key = '{} {}'.format(method.upper(), endpoint_name(uri_path))
+        with self._lock:
+            endpoint = self.requests.get(key)
+            if endpoint is None:
+                endpoint = self.requests[key] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'buckets': [0] * len(LATENCY_BUCKETS), 'statuses': {}}
+            endpoint['count'] += 1
+            endpoint['seconds'] += seconds
+            endpoint['max_seconds'] = max(endpoint['max_seconds'], seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    endpoint['buckets'][i] += 1
+                    break
+            status = str(status)
+            endpoint['statuses'][status] = endpoint['statuses'].get(status, 0) + 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self):
+        self.wall_time = time.time() - self.started
+
+    def report(self):
+        with self._lock:
+            return {
+                'script': self.script,
+                'tenant': self.tenant,
+                'started': self.started,
+                'wall_time': self.wall_time,
+                'max_rss': max_rss(),
+                'phases': dict((name, dict(phase))
+                               for name, phase in self.phases.items()),
+                'requests': dict((key, dict(
+                    endpoint, statuses=dict(endpoint['statuses']),
+                    buckets=dict(zip([str(x) for x in LATENCY_BUCKETS],
+                                     endpoint['buckets']))))
+                    for key, endpoint in self.requests.items()),
+                'counts': dict(self.counts),
+            }
+
+    def prometheus(self):
+        """
+        The report in the Prometheus text exposition format.  The latency
+        histogram buckets are cumulative, as Prometheus expects.
+        """
+        report = self.report()
+        base = {'script': self.script, 'tenant': self.tenant or ''}
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP scope_builder_{} {}'.format(name, help_text))
+            lines.append('# TYPE scope_builder_{} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('scope_builder_{}{}{} {}'.format(
+                    name, suffix, _labels(dict(base, **labels)), _value(value)))
+
+        metric('run_wall_seconds', 'gauge', 'Wall time of the run.',
+               [('', {}, report['wall_time'] or 0)])
+        metric('run_start_timestamp_seconds', 'gauge', 'Start time of the run.',
+               [('', {}, report['started'])])
+        phases = sorted(report['phases'].items())
+        metric('phase_wall_seconds', 'gauge', 'Wall time of each phase.',
+               [('', {'phase': name}, x['wall_time']) for name, x in phases])
+        metric('phase_cpu_seconds', 'gauge', 'CPU time of each phase.',
+               [('', {'phase': name}, x['cpu_time']) for name, x in phases])
+        metric('phase_max_rss_bytes', 'gauge',
+               'Memory high-water mark of the process at the end of each phase.',
+               [('', {'phase': name}, x['max_rss']) for name, x in phases
+                if x['max_rss'] is not None])
+
+        with self._lock:
+            requests = sorted((key, dict(endpoint, buckets=list(endpoint['buckets']),
+                                         statuses=dict(endpoint['statuses'])))
+                              for key, endpoint in self.requests.items())
+        samples = []
+        for key, endpoint in requests:
+            method, path = key.split(' ', 1)
+            for status, count in sorted(endpoint['statuses'].items()):
+                samples.append(('', {'method': method, 'endpoint': path,
+                                     'status': status}, count))
+        metric('api_requests_total', 'counter',
+               'API request attempts by endpoint and status.', samples)
+        samples = []
+        for key, endpoint in requests:
+            method, path = key.split(' ', 1)
+            labels = {'method': method, 'endpoint': path}
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, endpoint['buckets']):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le=_value(bound)), cumulative))
+            samples.append(('_sum', labels, endpoint['seconds']))
+            samples.append(('_count', labels, endpoint['count']))
+        metric('api_request_duration_seconds', 'histogram',
+               'API request latency by endpoint.', samples)
+        metric('items_total', 'counter', 'Rows, scopes and other items processed.',
+               [('', {'item': name}, value)
+                for name, value in sorted(report['counts'].items())])
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items())) + '}'
+
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def write_metrics(site_config, metrics):
+    """
+    Write the report of a run to the metrics files of its configuration,
+    if any.
+    """
+    if site_config.get('metrics_file'):
+        # The textfile collector may read at any time, so never expose a
+        # partial file
+        write_atomic(site_config['metrics_file'],
+                     json.dumps(metrics.report(), indent=1))
+        print('Wrote run metrics to {}'.format(site_config['metrics_file']))
+    if site_config.get('prometheus_file'):
+        write_atomic(site_config['prometheus_file'], metrics.prometheus())
+
+
+@contextlib.contextmanager
+def collect_metrics(site_config, script):
+    """
+    Instrument a run, writing its metrics when it ends, whether it finished
+    or failed.
+    """
+    metrics = RunMetrics(script, site_config.get('tenant'))
+    try:
+        yield metrics
+    finally:
+        metrics.finish()
+        write_metrics(site_config, metrics)
@@ -18,19 +18,158 @@ __license__ = "Cisco Sample Code License, Version 1.0"
 
 import pandas as pd
 import numpy as np
-import urllib3
+import requests
 import ipaddress
-from tetpyclient import RestClient
 import json
 import re
 import argparse
+import contextlib
 import getpass
+import hashlib
+import multiprocessing
 import os
-import re
-import tempfile
+import time
+from array import array
+from collections import deque
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor, wait,
+                                as_completed, FIRST_COMPLETED)
+from pandas.api.types import union_categoricals
+from tet_client import get_client, request_unsent, set_global_limit
+from scope_cache import open_cache, tenant_scopes
+from annotation_cache import file_digest, open_annotation_cache
+from cmdb_sync import (downloaded_annotations, diff_annotations, key_index,
+                       sync_annotations)
+from local_files import safe_name, write_atomic
+from run_metrics import RunMetrics, collect_metrics
+from scope_journal import open_journal
+from scope_query import check_queries, print_flagged
+
+
+class ScopeTree(object):
+    """
+    Scope hierarchy of one tenant as a prefix tree.
+
+    Nodes are integers indexing array-backed columns: the scope id, the
+    parent node and the short name, with node 0 the root scope.  Short names
+    are interned into a label table, so a value repeated under many parents
+    is stored once, and children are found through one dict keyed by the
+    parent node and label packed into an int.  Checking whether a scope
+    exists and finding its parent therefore never builds or hashes a full
+    ':'-joined name.  Scopes that are planned but not created yet have an id
+    of None.  Short names are expected stripped of surrounding whitespace,
+    and are matched regardless of case: a label keeps the spelling it was
+    first added with.
+    """
+    __slots__ = ('ids', 'parents', 'node_labels', 'labels', 'label_ids', 'children')
+
+    def __init__(self, root_name, root_id=None):
+        self.ids = [root_id]
+        self.parents = array('l', [-1])
+        self.labels = [root_name]
+        self.label_ids = {root_name.casefold(): 0}
+        self.node_labels = array('l', [0])
+        self.children = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, parent, short_name):
+        label = self.label_ids.get(short_name.casefold())
+        if label is None:
+            return None
+        return self.children.get(parent << 32 | label)
+
+    def add(self, parent, short_name, scope_id=None):
+        """
+        Return the node of short_name below parent, adding it if needed.
+        """
+        folded = short_name.casefold()
+        label = self.label_ids.get(folded)
+        if label is None:
+            label = len(self.labels)
+            self.labels.append(short_name)
+            self.label_ids[folded] = label
+        key = parent << 32 | label
+        node = self.children.get(key)
+        if node is None:
+            node = len(self.ids)
+            self.children[key] = node
+            self.ids.append(scope_id)
+            self.parents.append(parent)
+            self.node_labels.append(label)
+        elif scope_id is not None:
+            self.ids[node] = scope_id
+        return node
+
+    def add_path(self, full_name, scope_id=None):
+        """
+        Return the node of a full ':'-joined scope name, adding any missing
+        scopes along the way.
+        """
+        node = 0
+        for short_name in full_name.split(':')[1:]:
+            node = self.add(node, short_name.strip())
+        if scope_id is not None:
+            self.ids[node] = scope_id
+        return node
 
+    def full_name(self, node):
+        names = []
+        while node >= 0:
+            names.append(self.labels[self.node_labels[node]])
+            node = self.parents[node]
+        return ':'.join(reversed(names))
+
+    @classmethod
+    def from_listing(cls, root_scope_name, scopes):
+        """
+        Build the tree of a root scope from the /app_scopes listing, using
+        each scope's parent_app_scope_id and short_name.
+        """
+        root = [x for x in scopes if x['name'] == root_scope_name]
+        if len(root) == 0:
+            return cls(root_scope_name)
+        tree = cls(root_scope_name, root[0]['id'])
+        children = {}
+        for scope in scopes:
+            if scope.get('root_app_scope_id') == root[0]['id']:
+                children.setdefault(scope.get('parent_app_scope_id'), []).append(scope)
+        queue = deque([(root[0]['id'], 0)])
+        while queue:
+            scope_id, node = queue.popleft()
+            for scope in children.get(scope_id, []):
+                queue.append((scope['id'], tree.add(node, scope['short_name'].strip(),
+                                                    scope['id'])))
+        return tree
+
+
+def find_scope(parent, scope_name, rc):
+    """
+    Return the child scope scope_name of the scope with id parent, or None
+    if the cluster does not have it.
+    """
+    resp = rc.get('/app_scopes/{}'.format(parent))
+    if resp.status_code != 200:
+        return None
+    resp = rc.get('/app_scopes?root_app_scope_id={}'.format(
+        resp.json()['root_app_scope_id']))
+    if resp.status_code != 200:
+        return None
+    for scope in resp.json():
+        if scope.get('parent_app_scope_id') == parent and \
+                scope['short_name'].strip().lower() == scope_name.lower():
+            return scope
+    return None
+
+
+def create_scope(parent, scope_name, tag_name, tag_value, rc, attempts=3):
+    """
+    Create one scope and return it, or None if the cluster refused it.
 
-def create_scope(parent, scope_name, tag_name, tag_value, rc):
+    When the reply to the POST is lost, the cluster may have created the
+    scope anyway.  The scope is looked up before the POST is sent again, up
+    to attempts times.
+    """
     req_payload = {
         "short_name": "{}".format(scope_name),
         "short_query": {
@@ -40,12 +179,87 @@ def create_scope(parent, scope_name, tag_name, tag_value, rc):
         },
         "parent_app_scope_id": "{}".format(parent)
     }
-    resp = rc.post("/app_scopes", json_body=json.dumps(req_payload))
+    for attempt in range(attempts):
+        try:
+            resp = rc.post("/app_scopes", json_body=json.dumps(req_payload))
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if request_unsent(e):
+                raise
+            print('[WARNING] no reply creating scope {}, checking whether it exists: {}'.format(
+                scope_name, e))
+            scope = find_scope(parent, scope_name, rc)
+            if scope is not None:
+                return scope
+            if attempt == attempts - 1:
+                raise
     scope = resp.json()
     if resp.status_code != 200:
         print(resp.json())
-        return 1
-    return scope['id']
+        return None
+    return scope
+
+
+def create_scopes(operations, tree, rc, max_in_flight=8, cache=None,
+                  journal=None):
+    """
+    Create planned scopes concurrently while respecting the tree.
+
+    A scope is only submitted once its parent has an id in the tree, so the
+    tree is built level by level while siblings go out together through a
+    pool of at most max_in_flight requests.  When a scope fails, its whole
+    subtree is skipped.  Created scopes are written through to the scope
+    cache and every outcome is recorded in the journal.  Returns the failed
+    and skipped scope names.
+    """
+    children = {}
+    for operation in operations:
+        children.setdefault(operation['parent_node'], []).append(operation)
+
+    errors = []
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        def submit(parent):
+            for operation in children.pop(parent, []):
+                print('[CREATING SCOPE]: {}'.format(operation['name']))
+                future = executor.submit(
+                    create_scope, parent=tree.ids[parent],
+                    scope_name=operation['short_name'],
+                    tag_name=operation['tag'], tag_value=operation['value'],
+                    rc=rc)
+                pending[future] = operation
+
+        for parent in list(children):
+            if tree.ids[parent] is not None:
+                submit(parent)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                operation = pending.pop(future)
+                try:
+                    scope = future.result()
+                except Exception as e:
+                    print('[ERROR] creating scope {}: {}'.format(
+                        operation['name'], e))
+                    scope = None
+                if scope is None:
+                    errors.append(operation['name'])
+                    if journal is not None:
+                        journal.failed(operation)
+                else:
+                    tree.ids[operation['node']] = scope['id']
+                    if journal is not None:
+                        journal.created(operation, scope['id'])
+                    if cache is not None:
+                        cache.store(scope)
+                    submit(operation['node'])
+
+    # Whatever is left hangs below a scope that was never created
+    for parent in children:
+        for operation in children[parent]:
+            print('[SKIPPED SCOPE]: {}'.format(operation['name']))
+            errors.append(operation['name'])
+    return errors
 
 
 def get_columns():
@@ -68,194 +282,1562 @@ ex: Region, Security Zone, Application, Lifecycle
     return columns
 
 
-def supernet(ip, prefix):
-    address = ipaddress.ip_network(ip)
-    if address.prefixlen > prefix:
-        return str(address.supernet(new_prefix=int(prefix)))
+UINT64_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+# Characters not allowed in scope names
+INVALID_CHARS = [',']
+INVALID_CHARS_RE = re.compile('|'.join(re.escape(m) for m in INVALID_CHARS))
+# Longest tier value allowed in a scope name
+MAX_VALUE_LENGTH = 40
+# Column of the scope list with the number of annotation rows of each scope.
+# The leading underscore keeps it clear of the tier column names of an export
+COUNT_COLUMN = '_count'
+# Column with the key of each row in the watch command's state
+ROW_KEY_COLUMN = '_key'
+
+
+def _parse_ipv4(ips):
+    """
+    Parse dotted-quad IPv4 values without creating a Python object per row.
+    The strings are packed into a fixed-width byte matrix and the octets and
+    prefix length accumulated one character column at a time.  Returns the
+    address, prefix and a mask of the rows that parsed cleanly.
+    """
+    width = 18
+    try:
+        chars = np.array(ips, dtype='S{}'.format(width))
+    except UnicodeEncodeError:
+        return None
+    chars = chars.view(np.uint8).reshape(len(ips), width)
+    digit = (chars >= ord('0')) & (chars <= ord('9'))
+    separator = (chars == ord('.')) | (chars == ord('/'))
+    field = np.cumsum(separator, axis=1)
+    fields = np.zeros((len(ips), 5), dtype=np.uint32)
+    digits = np.zeros((len(ips), 5), dtype=np.uint8)
+    rows = np.arange(len(ips))
+    for position in range(width):
+        current = digit[:, position]
+        target = np.minimum(field[:, position], 4)
+        value = chars[:, position].astype(np.uint32) - ord('0')
+        fields[rows[current], target[current]] = \
+            fields[rows[current], target[current]] * 10 + value[current]
+        digits[rows[current], target[current]] += 1
+    slashes = (chars == ord('/')).sum(axis=1)
+    dots = (chars == ord('.')).sum(axis=1)
+    dots_before_slash = ((chars == ord('.')) & (field < 4)).sum(axis=1)
+    other = ~(digit | separator | (chars == 0))
+    valid = ((np.asarray(pd.Series(ips).str.len()) <= width) &
+             (dots == 3) & (dots_before_slash == 3) & (slashes <= 1) &
+             ~other.any(axis=1) &
+             (digits[:, :4] >= 1).all(axis=1) & (digits[:, :4] <= 3).all(axis=1) &
+             (fields[:, :4] <= 255).all(axis=1) &
+             ((slashes == 0) | ((digits[:, 4] >= 1) & (fields[:, 4] <= 32))))
+    address = ((fields[:, 0] << 24) | (fields[:, 1] << 16) |
+               (fields[:, 2] << 8) | fields[:, 3])
+    prefix = np.where(slashes == 1, fields[:, 4], 32).astype(np.uint8)
+    return address, prefix, valid
+
+
+def parse_ip_column(ips):
+    """
+    Parse an annotation IP column once into compact integer columns.
+
+    Every row gets its Version and Prefix as uint8 plus its network address.
+    A file with only IPv4 rows keeps the address as a uint32 NetLo column;
+    once IPv6 rows are present the address is split into NetHi/NetLo uint64
+    halves, with IPv4 rows holding zero in NetHi.
+    """
+    ips = pd.Series(ips)
+    count = len(ips)
+    version = np.full(count, 4, dtype=np.uint8)
+    prefix = np.zeros(count, dtype=np.uint8)
+    hi = np.zeros(count, dtype=np.uint64)
+    lo = np.zeros(count, dtype=np.uint64)
+
+    values = ips.values.astype(str)
+    is_v6 = np.asarray(ips.str.contains(':', regex=False), dtype=bool)
+    slow = is_v6.copy()
+    v4 = np.flatnonzero(~is_v6)
+    parsed = _parse_ipv4(values[v4]) if len(v4) else None
+    if parsed is None:
+        slow[v4] = True
+    else:
+        address, v4_prefix, valid = parsed
+        lo[v4] = address
+        prefix[v4] = v4_prefix
+        # Host bits set below the prefix are rejected just like ip_network
+        _, host_lo = host_mask(version[v4], v4_prefix)
+        valid &= (address & host_lo) == 0
+        slow[v4[~valid]] = True
+
+    # IPv6 rows (and anything the fast path could not read) go through
+    # ipaddress, once per distinct value.
+    networks = {}
+    for ip in pd.unique(values[slow]):
+        networks[ip] = ipaddress.ip_network(ip.strip())
+    for i in np.flatnonzero(slow):
+        network = networks[values[i]]
+        address = int(network.network_address)
+        version[i] = network.version
+        prefix[i] = network.prefixlen
+        hi[i] = address >> 64
+        lo[i] = address & 0xFFFFFFFFFFFFFFFF
+
+    frame = pd.DataFrame({'Version': version, 'Prefix': prefix},
+                         index=ips.index)
+    if (version == 6).any():
+        frame['NetHi'] = hi
+        frame['NetLo'] = lo
     else:
-        return np.nan
+        frame['NetLo'] = lo.astype(np.uint32)
+    return frame
+
+
+def ip_halves(networks):
+    """
+    Return version, prefix and the (hi, lo) uint64 halves of the network
+    addresses of a frame produced by parse_ip_column.
+    """
+    version = networks['Version'].values
+    prefix = networks['Prefix'].values
+    lo = networks['NetLo'].values.astype(np.uint64)
+    if 'NetHi' in networks:
+        hi = networks['NetHi'].values.astype(np.uint64)
+    else:
+        hi = np.zeros(len(networks), dtype=np.uint64)
+    return version, prefix, hi, lo
+
 
+def _low_bits(count):
+    """uint64 mask with the lowest count bits set (count may exceed 64)."""
+    count = np.clip(np.asarray(count, dtype=np.int64), 0, 64)
+    shift = np.minimum(count, 63).astype(np.uint64)
+    mask = (np.uint64(1) << shift) - np.uint64(1)
+    return np.where(count >= 64, UINT64_ONES, mask).astype(np.uint64)
 
-def common_abbreviations(scopes, abbreviations):
+
+def host_mask(version, prefix):
+    """
+    Return the (hi, lo) uint64 masks of the host bits below each prefix.
+    """
+    bits = np.where(np.asarray(version) == 4, 32, 128)
+    host = bits - np.asarray(prefix, dtype=np.int64)
+    return _low_bits(host - 64), _low_bits(host)
+
+
+def _search_segments(seg_hi, seg_lo, hi, lo):
+    """
+    Position of the last segment start <= each (hi, lo) address, or -1.
+    Segment starts must be sorted.  IPv4 keys fit in lo so a plain binary
+    search does; 128-bit keys are ranked with one lexsort of both sets.
+    """
+    if not seg_hi.any() and not hi.any():
+        return np.searchsorted(seg_lo, lo, side='right') - 1
+    segments = len(seg_lo)
+    is_query = np.concatenate([np.zeros(segments, dtype=bool),
+                               np.ones(len(lo), dtype=bool)])
+    order = np.lexsort((is_query, np.concatenate([seg_lo, lo]),
+                        np.concatenate([seg_hi, hi])))
+    latest = np.maximum.accumulate(np.where(order < segments, order, -1))
+    found = np.empty(len(lo), dtype=np.int64)
+    queries = order >= segments
+    found[order[queries] - segments] = latest[queries]
+    return found
+
+
+class PrefixIndex(object):
+    """
+    Longest-prefix-match index over the subnet rows of an annotation file.
+
+    CIDR blocks are either nested or disjoint, so once the subnets are sorted
+    by (network, prefix length) every subnet comes after the subnets covering
+    it.  A single stack pass over that order records the parent of each subnet
+    and flattens the nesting into disjoint segments, each owned by the most
+    specific subnet covering it.  Looking up an address is then a binary
+    search over the segment starts.
+    """
+
+    def __init__(self, version, hi, lo, prefix):
+        self.prefix = np.asarray(prefix, dtype=np.int16)
+        self.parent = np.full(len(self.prefix), -1, dtype=np.int64)
+        self.segments = {}
+        mask_hi, mask_lo = host_mask(version, prefix)
+        end_hi, end_lo = hi | mask_hi, lo | mask_lo
+        for v in np.unique(version):
+            positions = np.flatnonzero(version == v)
+            positions = positions[np.lexsort(
+                (prefix[positions], lo[positions], hi[positions]))]
+            start = [(int(h) << 64) | int(l) for h, l in
+                     zip(hi[positions], lo[positions])]
+            end = [(int(h) << 64) | int(l) for h, l in
+                   zip(end_hi[positions], end_lo[positions])]
+            seg_start = []
+            seg_owner = []
+            stack = []
+            for i, position in enumerate(positions):
+                while stack and end[stack[-1]] < start[i]:
+                    top = stack.pop()
+                    seg_start.append(end[top] + 1)
+                    seg_owner.append(positions[stack[-1]] if stack else -1)
+                self.parent[position] = positions[stack[-1]] if stack else -1
+                seg_start.append(start[i])
+                seg_owner.append(position)
+                stack.append(i)
+            while stack:
+                top = stack.pop()
+                seg_start.append(end[top] + 1)
+                seg_owner.append(positions[stack[-1]] if stack else -1)
+            # A segment may start just past the top of the address space;
+            # wrapping it to zero would break the sort, so drop it.
+            keep = [s < (1 << 128) for s in seg_start]
+            self.segments[v] = (
+                np.array([s >> 64 for s, k in zip(seg_start, keep) if k],
+                         dtype=np.uint64),
+                np.array([s & 0xFFFFFFFFFFFFFFFF for s, k in
+                          zip(seg_start, keep) if k], dtype=np.uint64),
+                np.array([o for o, k in zip(seg_owner, keep) if k],
+                         dtype=np.int64))
+        depth = np.zeros(len(self.prefix), dtype=np.int64)
+        ancestor = self.parent.copy()
+        while (ancestor >= 0).any():
+            depth[ancestor >= 0] += 1
+            ancestor[ancestor >= 0] = self.parent[ancestor[ancestor >= 0]]
+        self.max_depth = int(depth.max()) if len(depth) else 0
+
+    def lookup(self, version, hi, lo, prefix):
+        """
+        Return the position of the most specific subnet strictly covering each
+        network, or -1 where no subnet covers it.
+        """
+        owner = np.full(len(lo), -1, dtype=np.int64)
+        for v, (seg_hi, seg_lo, seg_owner) in self.segments.items():
+            mask = version == v
+            found = _search_segments(seg_hi, seg_lo, hi[mask], lo[mask])
+            owner[mask] = np.where(found >= 0, seg_owner[found], -1)
+        # The deepest segment owner may be the network itself (or one of its
+        # children for subnet rows), so climb until the prefix is shorter.
+        prefix = np.asarray(prefix, dtype=np.int16)
+        climb = owner >= 0
+        climb[climb] = self.prefix[owner[climb]] >= prefix[climb]
+        while climb.any():
+            owner[climb] = self.parent[owner[climb]]
+            climb[climb] = owner[climb] >= 0
+            climb[climb] = self.prefix[owner[climb]] >= prefix[climb]
+        return owner
+
+    def inherit(self, tags):
+        """
+        Fill each subnet's missing tags from its nearest ancestor that has
+        them.  Rows of tags must be in the order the index was built with.
+        """
+        resolved = tags.reset_index(drop=True)
+        has_parent = self.parent >= 0
+        for _ in range(self.max_depth):
+            inherited = resolved.iloc[np.where(has_parent, self.parent, 0)]
+            inherited = inherited.reset_index(drop=True)
+            inherited[~has_parent] = np.nan
+            for column in resolved.columns:
+                resolved[column] = resolved[column].fillna(inherited[column])
+        return resolved
+
+
+def collapse_prefix_tags(df, columns):
+    """
+    Apply longest prefix match to the annotation rows: every missing tag is
+    inherited from the most specific subnet row covering the IP that has a
+    value for that column.  df must carry the parse_ip_column columns.
+    """
+    version, prefix, hi, lo = ip_halves(df)
+    # Only subnets shorter than a host route can strictly cover another row
+    is_subnet = prefix < np.where(version == 4, 32, 128)
+    if not is_subnet.any():
+        return df
+
+    # Duplicate subnet rows are merged so each network has one set of tags
+    subnets = df.loc[is_subnet, columns].copy()
+    keys = ['_version', '_hi', '_lo', '_prefix']
+    for key, values in zip(keys, (version, hi, lo, prefix)):
+        subnets[key] = values[is_subnet]
+    subnets = subnets.groupby(keys, sort=False).first().reset_index()
+
+    index = PrefixIndex(subnets['_version'].values, subnets['_hi'].values,
+                        subnets['_lo'].values, subnets['_prefix'].values)
+    resolved = index.inherit(subnets[columns])
+    owner = index.lookup(version, hi, lo, prefix)
+
+    inherited = resolved.iloc[np.where(owner >= 0, owner, 0)].copy()
+    inherited.index = df.index
+    inherited[owner < 0] = np.nan
+    df = df.copy()
+    for column in columns:
+        df[column] = df[column].fillna(inherited[column])
+    return df
+
+
+def parse_ips(ips, workers=0):
+    """
+    parse_ip_column, with the rows split into one chunk per worker process
+    when workers is over 1.
+    """
+    if workers < 2 or len(ips) < 2 * workers:
+        return parse_ip_column(ips)
+    bounds = np.linspace(0, len(ips), workers + 1).astype(np.int64)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        frames = list(executor.map(parse_ip_column, [ips.iloc[start:end] for start, end
+                                                     in zip(bounds[:-1], bounds[1:])]))
+    # A chunk with only IPv4 rows has no NetHi and a 32 bit NetLo
+    if any('NetHi' in frame for frame in frames):
+        for frame in frames:
+            if 'NetHi' not in frame:
+                frame.insert(2, 'NetHi', np.zeros(len(frame), dtype=np.uint64))
+                frame['NetLo'] = frame['NetLo'].astype(np.uint64)
+    return pd.concat(frames)
+
+
+def shard_rows(df, shards):
+    """
+    Split a parsed annotation table into up to shards ranges of the address
+    space with about as many rows each, rows with the same address always in
+    the same range.  A subnet row whose network reaches into later ranges is
+    replicated into them, so each row has every subnet covering it in its
+    own shard.  Returns the positions of the rows and of the replicas of
+    each shard that has rows.
+    """
+    version, prefix, hi, lo = ip_halves(df)
+    count = len(df)
+    order = np.lexsort((lo, hi, version))
+    sorted_version, sorted_hi, sorted_lo = version[order], hi[order], lo[order]
+    change = np.r_[True, (sorted_version[1:] != sorted_version[:-1]) |
+                   (sorted_hi[1:] != sorted_hi[:-1]) | (sorted_lo[1:] != sorted_lo[:-1])]
+    first = np.maximum.accumulate(np.where(change, np.arange(count), 0))
+    sorted_shard = first * shards // max(count, 1)
+    shard = np.empty(count, dtype=np.int64)
+    shard[order] = sorted_shard
+
+    # The shard of the last row inside each subnet
+    subnets = np.flatnonzero(prefix < np.where(version == 4, 32, 128))
+    mask_hi, mask_lo = host_mask(version[subnets], prefix[subnets])
+    end_hi, end_lo = hi[subnets] | mask_hi, lo[subnets] | mask_lo
+    last = shard[subnets].copy()
+    for v in np.unique(version[subnets]):
+        block = np.flatnonzero(sorted_version == v)
+        selected = version[subnets] == v
+        found = _search_segments(sorted_hi[block], sorted_lo[block],
+                                 end_hi[selected], end_lo[selected])
+        last[selected] = sorted_shard[block[0] + found]
+    spans = last - shard[subnets]
+    replicas = np.repeat(subnets, spans)
+    offsets = np.arange(len(replicas)) - np.repeat(np.cumsum(spans) - spans, spans)
+    replica_shard = np.repeat(shard[subnets], spans) + 1 + offsets
+
+    rows_order = np.argsort(shard, kind='stable')
+    row_bounds = np.searchsorted(shard[rows_order], np.arange(shards + 1))
+    replica_order = np.argsort(replica_shard, kind='stable')
+    replica_bounds = np.searchsorted(replica_shard[replica_order], np.arange(shards + 1))
+    return [(rows_order[row_bounds[k]:row_bounds[k + 1]],
+             replicas[replica_order[replica_bounds[k]:replica_bounds[k + 1]]])
+            for k in range(shards) if row_bounds[k + 1] > row_bounds[k]]
+
+
+def group_shard(shard, columns):
+    """
+    Collapse and group one shard in a worker process.  Replicated subnet
+    rows pass their tags on but are counted in their own shard only.
+    """
+    shard = collapse_prefix_tags(shard, columns)
+    shard = shard[~shard.pop('_replica').values]
+    return shard.groupby(columns, observed=True).size().reset_index(name=COUNT_COLUMN)
+
+
+# Column profiles by hash of the column values, shared by the checks of a
+# run and by later runs in the same process
+_profiles = {}
+PROFILE_CACHE_SIZE = 256
+
+
+def profile_column(values):
+    """
+    Profile one tier column in a single pass over its rows: its distinct
+    values in order of appearance, their share of the rows, the number of
+    empty values and the distinct values that are over MAX_VALUE_LENGTH or
+    contain INVALID_CHARS.  The rows are only factorized, the string checks
+    look at the distinct values.  Returns the hash of the column and its
+    profile.
+    """
+    codes, distinct = pd.factorize(values.values, use_na_sentinel=False)
+    distinct = pd.Series(distinct, dtype=object)
+    digest = hashlib.sha1(codes.astype(np.int64).tobytes())
+    # The values are distinct already, so they are hashed as they are
+    digest.update(pd.util.hash_pandas_object(distinct, index=False,
+                                             categorize=False).values.tobytes())
+    digest = digest.hexdigest()
+    profile = _profiles.get(digest)
+    if profile is not None:
+        return digest, profile
+
+    long_values = []
+    invalid_values = []
+    for value in distinct.values:
+        if isinstance(value, str):
+            if len(value) > MAX_VALUE_LENGTH:
+                long_values.append(value)
+            if INVALID_CHARS_RE.search(value):
+                invalid_values.append(value)
+    profile = {
+        'values': distinct.values,
+        'ratio': float(len(distinct)) / len(values) if len(values) else 0.0,
+        'nulls': int(np.bincount(codes, minlength=len(distinct))[distinct.isna().values].sum()),
+        'long': long_values,
+        'invalid': invalid_values,
+    }
+    return digest, profile
+
+
+def profile_columns(scopes, columns=None, max_workers=None):
+    """
+    Profile the tier columns of the scope list, in parallel across columns.
+    Profiles are cached by the hash of the column, so the string checks of a
+    column that has not changed are not redone.  Returns {column: profile}.
+    """
+    if columns is None:
+        columns = [x for x in scopes.columns if x != COUNT_COLUMN]
+
+    def profile(column):
+        digest, profile = profile_column(scopes[column])
+        if digest not in _profiles:
+            if len(_profiles) >= PROFILE_CACHE_SIZE:
+                _profiles.clear()
+            _profiles[digest] = profile
+        return profile
+
+    if len(columns) == 0:
+        return {}
+    max_workers = max_workers or min(len(columns), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(columns, executor.map(profile, columns)))
+
+
+def common_abbreviations(scopes, abbreviations, profiles=None):
     print('Checking abbreviations for common scope layers...')
-    total = len(scopes)
-    for column in scopes.columns:
-        if column != 'IP':
-            values = scopes[column].unique()
-            if float(len(values))/total < .1:
-                if column not in abbreviations:
-                    abbreviations[column] = {}
-                for item in values:
-                    if item not in abbreviations[column] and isinstance(item,str):
-                        r = input(
-                            'Create an abbreviation for Value: "{}" in Column: "{}" (Leave blank if none desired):'.format(item, column))
-                        if len(r) > 0:
-                            abbreviations[column][item] = r
-                        else:
-                            abbreviations[column][item] = None
-
-def long_abbreviations(scopes, abbreviations):
+    profiles = profiles or profile_columns(scopes)
+    for column, profile in profiles.items():
+        if profile['ratio'] < .1:
+            if column not in abbreviations:
+                abbreviations[column] = {}
+            for item in profile['values']:
+                if item not in abbreviations[column] and isinstance(item,str):
+                    r = input(
+                        'Create an abbreviation for Value: "{}" in Column: "{}" (Leave blank if none desired):'.format(item, column))
+                    if len(r) > 0:
+                        abbreviations[column][item] = r
+                    else:
+                        abbreviations[column][item] = None
+
+def long_abbreviations(scopes, abbreviations, profiles=None):
     print('Checking abbreviations for long fields...')
-    for column in scopes.columns:
-        if column != 'IP':
-            long_names = scopes[column][scopes[column].str.len()>40].unique()
-            if len(long_names) > 0:
-                if column not in abbreviations:
-                    abbreviations[column] = {}
-                for item in long_names:
-                    if item not in abbreviations[column] and isinstance(item,str):
-                        r = input(
-                            'MANDATORY: Create an abbreviation for Value: "{}" in Column: "{}":'.format(item, column))
-                        if len(r) > 0:
-                            abbreviations[column][item] = r
-                        else:
-                            abbreviations[column][item] = None
-
-def remove_invalid_chars(scopes,abbreviations):
-    print('Removing invalid characters...')
-    invalid_char_list=[',']
-    safe_invalid_char_list = [re.escape(m) for m in invalid_char_list]
-    for column in scopes.columns:
-        if column != 'IP':
-            invalid_names = scopes[column][scopes[column].str.contains('|'.join(safe_invalid_char_list))].unique()
-            if len(invalid_names) > 0:
-                if column not in abbreviations:
-                    abbreviations[column] = {}
-                for item in invalid_names:
-                    if item not in abbreviations[column] and isinstance(item,str):
-                        abbreviated = item
-                        for char in invalid_char_list:
-                            abbreviated = abbreviated.replace(char,'')
-                        print(abbreviated)
-                        abbreviations[column][item] = abbreviated
-
-def shorten_scope(root_scope_name, scope, abbreviations):
-    shortened_columns = []
-    for index in scope.index:
-        if index in abbreviations:
-            if scope[index] in abbreviations[index] and abbreviations[index][scope[index]] != None:
-                scope[index] = abbreviations[index][scope[index]]
-                shortened_columns.append(index)
-
-    scope_long_name = ':'.join([root_scope_name]+list(scope))
-    if len(scope_long_name) > 400:
-        for attribute in scope.index:
-            if attribute not in shortened_columns:
-                if attribute not in abbreviations:
-                    abbreviations[attribute] = {}
-                if scope[attribute] not in abbreviations[attribute]:
-                    r = input('This scope is too long.  Please create an abbreviation for Value: "{}" in Column: "{}" (Leave blank if none desired):'.format(
-                        scope[attribute], attribute))
+    profiles = profiles or profile_columns(scopes)
+    for column, profile in profiles.items():
+        if len(profile['long']) > 0:
+            if column not in abbreviations:
+                abbreviations[column] = {}
+            for item in profile['long']:
+                if item not in abbreviations[column]:
+                    r = input(
+                        'MANDATORY: Create an abbreviation for Value: "{}" in Column: "{}":'.format(item, column))
                     if len(r) > 0:
-                        abbreviations[attribute][scope[attribute]] = r
-                        scope[attribute] = r
+                        abbreviations[column][item] = r
                     else:
-                        abbreviations[attribute][scope[attribute]] = None
-    return scope
+                        abbreviations[column][item] = None
 
+def remove_invalid_chars(scopes, abbreviations, profiles=None):
+    print('Removing invalid characters...')
+    profiles = profiles or profile_columns(scopes)
+    for column, profile in profiles.items():
+        if len(profile['invalid']) > 0:
+            if column not in abbreviations:
+                abbreviations[column] = {}
+            for item in profile['invalid']:
+                if item not in abbreviations[column]:
+                    abbreviated = item
+                    for char in INVALID_CHARS:
+                        abbreviated = abbreviated.replace(char,'')
+                    print(abbreviated)
+                    abbreviations[column][item] = abbreviated
 
-def build_scopes(site_config, tenant_config):
-    # Create Tetration API RestClient
-    rc = RestClient(
-        site_config['url'], credentials_file=site_config['creds'], verify=False)
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-    root_scope_name = site_config['tenant']
-    columns = tenant_config['columns']
+def load_abbreviation_rules(file_path=None):
+    """
+    Load the rules used by auto_abbreviate from a JSON file:
+
+    {
+      "rules": [
+        {"pattern": "(?i)data ?cent(er|re)", "template": "DC"},
+        {"column": "Environment", "pattern": "^Production$", "template": "Prod"}
+      ],
+      "max_length": 40,
+      "hash_length": 4
+    }
+
+    Rules are regular expression substitutions applied in order, to every
+    column or only to the column named in the rule.  Without a file only
+    truncation and collision suffixes are applied.
+    """
+    rules = {'rules': [], 'max_length': 40, 'hash_length': 4}
+    if file_path:
+        with open(file_path) as f:
+            rules.update(json.load(f))
+    for rule in rules['rules']:
+        rule['regex'] = re.compile(rule['pattern'])
+    return rules
+
+
+def _hashed(short, value, limit, hash_length):
+    """
+    Cut short so that a '-' and a hash of the original value fit within
+    limit characters, and append them.
+    """
+    digest = hashlib.sha1(value.encode('utf-8')).hexdigest()[:hash_length]
+    return short[:max(limit - hash_length - 1, 0)].rstrip() + '-' + digest
+
+
+def _resolve_column(values, column, abbreviations, rules):
+    """
+    Abbreviate the distinct values of one column that have no abbreviation
+    yet, or whose abbreviation is over the value limit.  Returns the values
+    resolved and their short names.
+    """
+    max_length = rules['max_length']
+    hash_length = rules['hash_length']
+    mapping = {k: v for k, v in abbreviations.items() if v != None}
+    short = values.map(mapping).fillna(values)
+    pending = ~values.isin(list(abbreviations)) | (short.str.len() > max_length)
+
+    candidate = values[pending]
+    for rule in rules['rules']:
+        if rule.get('column', column) == column:
+            candidate = candidate.str.replace(rule['regex'], rule['template'],
+                                              regex=True)
+    for char in INVALID_CHARS:
+        candidate = candidate.str.replace(char, '', regex=False)
+    candidate = candidate.str.strip()
+    candidate = candidate.where(candidate.str.len() > 0, values[pending])
+    too_long = candidate.str.len() > max_length
+    candidate[too_long] = [_hashed(c, v, max_length, hash_length) for c, v in
+                           zip(candidate[too_long], values[pending][too_long])]
+    short[pending] = candidate
+
+    # Values that only differ in case are meant to share a scope, anything
+    # else ending up on the same (case-insensitive) name is a collision.  A
+    # value that kept its own name keeps it, the renamed ones get a suffix.
+    originals = values.str.lower().groupby(short.str.lower().values).transform('nunique')
+    collided = pending & (originals > 1).values & (short != values)
+    short[collided] = [_hashed(s, v, max_length, hash_length) for s, v in
+                       zip(short[collided], values[collided])]
+    return values[pending], short[pending]
+
+
+def auto_abbreviate(scopes, columns, root_scope_name, abbreviations, rules,
+                    profiles=None):
+    """
+    Non-interactive replacement for common_abbreviations,
+    long_abbreviations and shorten_scopes.  Every value is resolved from the
+    rules in one pass per column, values are kept within the 40 character
+    limit and, where a full name is still over 400 characters, the values of
+    that scope are cut to an equal share of the limit.  Values that get a new
+    short name are saved to abbreviations, values kept as they are only if
+    they already had an entry.
+    """
+    print('Resolving abbreviations from rules...')
+    profiles = profiles or profile_columns(scopes, columns)
+    resolved = {}
+    for column in columns:
+        if column not in abbreviations:
+            abbreviations[column] = {}
+        values = pd.Series(profiles[column]['values'], dtype=object)
+        resolved[column] = dict(zip(*_resolve_column(values, column,
+                                                     abbreviations[column], rules)))
+        for value, short in resolved[column].items():
+            if short != value or value in abbreviations[column]:
+                abbreviations[column][value] = short if short != value else None
+
+    short, long_names = scope_names(scopes, columns, root_scope_name,
+                                    abbreviations)
+    too_long = (long_names.str.len() > 400).values
+    if too_long.any():
+        share = (400 - len(root_scope_name)) // len(columns) - 1
+        for column in columns:
+            over = short[column][too_long]
+            over = over[over.str.len() > share]
+            values = scopes[column][too_long][over.index]
+            for value, name in zip(values.values, over.values):
+                abbreviations[column][value] = _hashed(
+                    name, value, share, rules['hash_length'])
+    print('Resolved {} abbreviations.'.format(
+        sum(len(x) for x in resolved.values())))
+
+def scope_names(scopes, columns, root_scope_name, abbreviations):
+    """
+    Resolve scope names column-wise: every tier value is mapped through its
+    abbreviation (where one is set) and the full ':'-joined names are built
+    from the resulting short names.
+    """
+    short = pd.DataFrame(index=scopes.index)
+    for column in columns:
+        mapping = {k: v for k, v in abbreviations.get(column, {}).items()
+                   if v != None}
+        short[column] = scopes[column].map(mapping).fillna(scopes[column])
+    long_names = pd.Series(root_scope_name, index=scopes.index)
+    for column in columns:
+        long_names = long_names + ':' + short[column]
+    return short, long_names
+
+
+def shorten_scopes(scopes, columns, abbreviations):
+    """
+    Ask for abbreviations for the values of scopes whose full name is too
+    long, for every value that has not been asked about yet.
+    """
+    for values in zip(*[scopes[column].values for column in columns]):
+        for attribute, value in zip(columns, values):
+            if attribute not in abbreviations:
+                abbreviations[attribute] = {}
+            if value not in abbreviations[attribute]:
+                r = input('This scope is too long.  Please create an abbreviation for Value: "{}" in Column: "{}" (Leave blank if none desired):'.format(
+                    value, attribute))
+                if len(r) > 0:
+                    abbreviations[attribute][value] = r
+                else:
+                    abbreviations[attribute][value] = None
+
+
+def plan_scopes(scopes, columns, root_scope_name, tree, abbreviations,
+                prompt=True):
+    """
+    Walk the scope frame and return the scopes missing from the tree as
+    create operations (parents before children), adding them to the tree
+    without an id.  Also returns the full names that are still over the 400
+    character limit.  With prompt set, the user
+    is first asked to shorten the names that are too long.
+    """
+    short, long_names = scope_names(scopes, columns, root_scope_name,
+                                    abbreviations)
+    too_long = (long_names.str.len() > 400).values
+    if prompt and too_long.any():
+        shorten_scopes(scopes[too_long], columns, abbreviations)
+        short, long_names = scope_names(scopes, columns, root_scope_name,
+                                        abbreviations)
+    errors = list(long_names[long_names.str.len() > 400])
 
-    # Download Annotations File for Root Scope and Load into Pandas Data Frame
-    tempfile.gettempdir()
-    file_path = tempfile.tempdir + '/temp_annotations.csv'
-    rc.download(file_path, '/assets/cmdb/download/' + root_scope_name)
-    df = pd.read_csv(tempfile.tempdir+ "/temp_annotations.csv")
-
-    # Filter Annotations to only the relevant columns and entries witn non-null values in at least one of the columns
-    print(df.columns)
-    df = df[columns+['IP']].set_index('IP').dropna(how='all').reset_index()
-
-    # Collapse longest prefix match tags
-    subnets = df[df['IP'].str.contains('/')].rename(columns={'IP': 'Subnet'})
-    subnets['Mask'] = subnets['Subnet'].apply(lambda x: int(x.split('/')[1]))
-    prefix_list = list(subnets['Mask'].unique())
-    prefix_list.sort(reverse=True)
-    subnets.drop(columns='Mask', inplace=True)
-    for prefix in prefix_list:
-        df['Subnet'] = df['IP'].apply(lambda x: supernet(x, prefix))
-        if not df['Subnet'].isnull().all():
-            merged = pd.merge(
-                subnets, df[['IP', 'Subnet']], on='Subnet').set_index('IP')
-            df = df.set_index('IP').combine_first(merged).reset_index()
+    # The frame comes out of a groupby sorted by its columns, so a row
+    # usually shares its upper levels with the row before it.  Those nodes
+    # are reused and only the levels that changed are looked up in the tree.
+    # Full names are only built for the scopes being planned.
+    operations = []
+    full_names = {}
+    path = [0] * len(columns)
+    previous = ()
+    rows = zip(zip(*[short[column].str.strip().to_numpy() for column in columns]),
+               zip(*[short[column].to_numpy() for column in columns]),
+               zip(*[scopes[column].to_numpy() for column in columns]))
+    for keys, names, values in rows:
+        level = 0
+        while level < len(previous) and keys[level] == previous[level]:
+            level += 1
+        parent = path[level - 1] if level else 0
+        for level in range(level, len(columns)):
+            node = tree.find(parent, keys[level])
+            if node is None:
+                node = tree.add(parent, keys[level])
+                parent_name = full_names.get(parent) or tree.full_name(parent)
+                full_names[node] = parent_name + ':' + keys[level]
+                operations.append({'name': full_names[node],
+                                   'parent': parent_name,
+                                   'short_name': names[level],
+                                   'tag': columns[level], 'value': values[level],
+                                   'node': node, 'parent_node': parent})
+            path[level] = parent = node
+        previous = keys
+    return operations, errors
+
+
+def _concat_categoricals(parts):
+    """
+    Concatenate categorical chunks of one column.  A chunk where the column
+    is entirely empty has no categories to infer a dtype from, so it is
+    aligned to the dtype of the other chunks first.
+    """
+    dtypes = [part.cat.categories.dtype for part in parts
+              if len(part.cat.categories)]
+    dtype = dtypes[0] if len(dtypes) else object
+    return union_categoricals([part.cat.set_categories(part.cat.categories.astype(dtype))
+                               for part in parts])
+
+
+def normalize_tier(values):
+    """
+    Merge the categories of a tier column that only differ in case or
+    surrounding whitespace into one canonical value, the spelling with the
+    most rows.  Only the category table and the integer codes are rewritten,
+    so every later step sees one value per normalized key.
+    """
+    categories = values.cat.categories
+    keys = pd.Index(categories.astype(str)).str.strip().str.casefold()
+    key_codes, unique_keys = pd.factorize(keys)
+    if len(unique_keys) == len(categories):
+        return values
+    codes = values.cat.codes.to_numpy()
+    rows = np.bincount(codes[codes >= 0], minlength=len(categories))
+    # The most common spelling of each key; on a tie one without surrounding
+    # whitespace, then the first in sort order
+    names = pd.Index(categories.astype(str))
+    padded = np.asarray(names != names.str.strip())
+    spelling = np.argsort(np.argsort(np.asarray(names), kind='stable'))
+    order = np.lexsort((spelling, padded, -rows, key_codes))
+    _, first = np.unique(key_codes[order], return_index=True)
+    canonical = categories[order[first]]
+    codes = np.where(codes >= 0, key_codes[np.maximum(codes, 0)], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, canonical),
+                     index=values.index, name=values.name)
+
+
+def read_annotations(file_path, columns, chunksize=None):
+    """
+    Read the IP column and the tier columns of an annotation file, skipping
+    every other column at parse time.  Tier columns are loaded as
+    categoricals and rows without a value in any tier column are dropped,
+    per chunk when chunksize is given, so peak memory follows the tier
+    columns rather than the full export.  Values of a tier column that only
+    differ in case or surrounding whitespace are merged by normalize_tier.
+    """
+    dtype = {column: 'category' for column in columns}
+    dtype['IP'] = str
+    reader = pd.read_csv(file_path, usecols=columns+['IP'], dtype=dtype,
+                         chunksize=chunksize or None)
+    if not chunksize:
+        df = reader[columns+['IP']].dropna(how='all', subset=columns)
+        df = df.reset_index(drop=True)
+        for column in columns:
+            df[column] = normalize_tier(df[column])
+        return df
+
+    chunks = [chunk.dropna(how='all', subset=columns) for chunk in reader]
+    if len(chunks) == 0:
+        return pd.read_csv(file_path, usecols=columns+['IP'], dtype=dtype,
+                           nrows=0)[columns+['IP']]
+    df = pd.DataFrame({column: _concat_categoricals([chunk[column] for chunk in chunks])
+                       for column in columns})
+    for column in columns:
+        df[column] = normalize_tier(df[column])
+    df['IP'] = pd.concat([chunk['IP'] for chunk in chunks], ignore_index=True)
+    return df
+
+
+def group_scopes(df, columns, metrics=None, workers=0):
+    """
+    Collapse the longest prefix match tags of a parsed annotation table and
+    group it into the scope list: one row per distinct combination of tier
+    values, with its number of annotation rows in COUNT_COLUMN.  Only the
+    group sizes are kept, so the scope list grows with the number of scopes
+    rather than the number of IPs.
+
+    With workers over 1 the table is split into address space shards by
+    shard_rows, each shard is collapsed and grouped in a worker process and
+    the scope lists of the shards are added up.
+    """
+    metrics = metrics or RunMetrics('scope_builder')
+    if workers > 1 and len(df) >= 2 * workers:
+        with metrics.phase('shard'):
+            frame = df[columns + [x for x in ('Version', 'Prefix', 'NetHi', 'NetLo')
+                                  if x in df.columns]]
+            shards = []
+            for rows, replicas in shard_rows(frame, workers):
+                shard = frame.iloc[np.r_[rows, replicas]].reset_index(drop=True)
+                shard['_replica'] = np.arange(len(shard)) >= len(rows)
+                shards.append(shard)
+        with metrics.phase('collapse'):
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = list(executor.map(group_shard, shards,
+                                          [columns] * len(shards)))
+        with metrics.phase('group'):
+            # The tier columns are still categoricals of the same categories,
+            # so the merged list comes out in the order of group_paths
+            scopes = pd.concat(parts, ignore_index=True)
+            scopes = scopes.groupby(columns, observed=True)[COUNT_COLUMN].sum()
+            scopes = scopes.reset_index()
+            for column in columns:
+                scopes[column] = scopes[column].astype(object)
+        return scopes
+
+    with metrics.phase('collapse'):
+        df = collapse_prefix_tags(df, columns)
 
     # Create scope list from annotations file
-    #scopes = df.replace(np.nan, "nan").groupby(columns)['IP'].apply(list)
-    scopes = df.groupby(columns)['IP'].apply(list)
-    scopes = scopes.reset_index()
-    for column in scopes.columns:
-        scopes[column]=scopes[column].astype(str)
-    #scopes=scopes.replace('nan',np.nan)
-
-    # Gather existing scopes and IDs
-    scope_ids = {}
-    resp = rc.get('/openapi/v1/app_scopes/')
-    if resp.status_code == 200:
-        current_scopes = resp.json()
-        root_scope = [
-            x for x in current_scopes if x['name'] == root_scope_name]
-        if len(root_scope) > 0:
-            root_scope_id = root_scope[0]['id']
-            current_scopes = [
-                x for x in current_scopes if x['root_app_scope_id'] == root_scope_id]
-            for scope in current_scopes:
-                scope_ids[scope['name']] = scope['id']
-
-    # Build common abbreviations
-    common_abbreviations(scopes, tenant_config['abbreviations'])
-
-    # Build abbreviations for long fields
-    long_abbreviations(scopes, tenant_config['abbreviations'])
-
-    # Remove invalid characters in scope names
-    remove_invalid_chars(scopes, tenant_config['abbreviations'])
-
-    inv_abbreviations = {}
-    print(tenant_config['abbreviations'])
-    for item in tenant_config['abbreviations']:
-        inv_abbreviations[item] = {
-            v: k for k, v in tenant_config['abbreviations'][item].items()}
-    print(inv_abbreviations)
-
-    # Create new scopes
-    errors = []
-    i = 0
-    while i < len(scopes):
+    with metrics.phase('group'):
+        return group_paths(df, columns)
+
+
+def group_paths(df, columns):
+    """
+    One row per distinct combination of tier values of a collapsed table,
+    with its number of annotation rows in COUNT_COLUMN.
+    """
+    scopes = df.groupby(columns, observed=True).size()
+    scopes = scopes.reset_index(name=COUNT_COLUMN)
+    # Plain values from here on; astype(str) would turn a missing value
+    # into the string 'nan'
+    for column in columns:
+        scopes[column]=scopes[column].astype(object)
+    return scopes
+
+
+def load_scopes(rc, root_scope_name, columns, chunksize=None, cache=None,
+                metrics=None, workers=0):
+    """
+    Download the CMDB export for the root scope and return its scope list.
+
+    Only the IP column and the tier columns are read from the export, see
+    read_annotations.  With an annotation cache the export is hashed first.
+    If the scope list of the same export and columns is cached it is
+    returned as is; if only the parsed annotation table of those columns
+    is, the parse is skipped and only the collapse is redone.  Otherwise
+    the export is parsed and both tables are saved for the next run.
+
+    workers over 1 parses the export and builds the scope list in that many
+    processes, see parse_ips and group_scopes.
+    """
+    metrics = metrics or RunMetrics('scope_builder')
+    df = None
+    with downloaded_annotations(rc, root_scope_name, metrics) as file_path:
+        if cache is not None:
+            with metrics.phase('cache'):
+                digest = file_digest(file_path)
+                scopes = cache.load(digest, columns, grouped=True)
+            if scopes is not None:
+                print('Annotations unchanged, using the cached scope list.')
+                return scopes
+            with metrics.phase('cache'):
+                df = cache.load(digest, columns)
+            if df is not None:
+                print('Annotations unchanged, using the cached annotation table.')
+        if df is None:
+            with metrics.phase('parse'):
+                df = read_annotations(file_path, columns, chunksize)
+                # Only the parsed networks are needed from here on
+                df = df.join(parse_ips(df.pop('IP'), workers))
+            if cache is not None:
+                with metrics.phase('cache'):
+                    cache.save(digest, df, columns)
+
+    metrics.count('annotation_rows', len(df))
+    scopes = group_scopes(df, columns, metrics, workers)
+    if cache is not None:
+        with metrics.phase('cache'):
+            cache.save(digest, scopes, columns, grouped=True)
+    return scopes
+
+
+def plan_lines(operations, tree):
+    """
+    Planned create operations in their saved form, parents before children.
+    A parent that already exists is referenced by its parent_id; otherwise
+    the parent is an earlier operation.
+    """
+    lines = []
+    for operation in operations:
+        line = dict(operation)
+        del line['node'], line['parent_node']
+        if tree.ids[operation['parent_node']] is not None:
+            line['parent_id'] = tree.ids[operation['parent_node']]
+        lines.append(line)
+    return lines
+
+
+def plan_operations(lines):
+    """
+    Turn saved plan lines back into operations.  Returns the operations and
+    a tree of the scopes they create and the existing scopes they hang from.
+    """
+    operations = []
+    tree = None
+    for line in lines:
+        operation = dict(line)
+        if tree is None:
+            tree = ScopeTree(operation['parent'].split(':')[0])
+        operation['parent_node'] = tree.add_path(
+            operation['parent'], operation.pop('parent_id', None))
+        operation['node'] = tree.add(operation['parent_node'],
+                                     operation['short_name'].strip())
+        operations.append(operation)
+    return operations, tree
+
+
+def write_plan(file_path, operations, tree):
+    """
+    Save planned create operations as JSON lines.
+    """
+    with open(file_path, 'w') as outfile:
+        for line in plan_lines(operations, tree):
+            outfile.write(json.dumps(line, sort_keys=True) + '\n')
+
+
+def read_plan(file_path):
+    """
+    Load a plan written by write_plan.
+    """
+    with open(file_path) as f:
+        return plan_operations(json.loads(line) for line in f
+                               if len(line.strip()))
+
+
+def push_scopes(site_config, operations, tree, rc, cache=None):
+    """
+    Create planned scopes, recording each outcome in the tenant's journal so
+    an interrupted push can be resumed.  Returns the failed scope names.
+    """
+    journal = open_journal(site_config)
+    if journal is not None:
+        journal.start(plan_lines(operations, tree))
+    errors = create_scopes(operations, tree, rc,
+                           max_in_flight=site_config['max_in_flight'],
+                           cache=cache, journal=journal)
+    if journal is not None:
+        journal.finish(errors)
+    return errors
+
+
+def resume_push(site_config, rc, metrics, cache=None):
+    """
+    Finish the push of an interrupted run of the tenant from its journal.
+    Scopes the journal saw created keep their ids.  The rest are looked up
+    by name in one listing of the tenant's scopes, and only the scopes still
+    missing are sent.  cache is the scope cache of the run, if any.  Returns
+    the run summary, or None when there is nothing to resume.
+    """
+    journal = open_journal(site_config)
+    interrupted = journal.interrupted() if journal is not None else None
+    if interrupted is None:
+        return None
+    lines, created = interrupted
+    operations, tree = plan_operations(lines)
+    for operation in operations:
+        if operation['name'] in created:
+            tree.ids[operation['node']] = created[operation['name']]
+    remaining = [x for x in operations if tree.ids[x['node']] is None]
+    if remaining:
+        # Creates that completed after the crash are in neither the journal
+        # nor the cache, so the scopes are listed from the cluster
+        existing = dict((x['name'], x['id']) for x in tenant_scopes(
+            rc, site_config['tenant'], cache, refresh=True) or [])
+        for operation in remaining:
+            tree.ids[operation['node']] = existing.get(operation['name'])
+        remaining = [x for x in remaining if tree.ids[x['node']] is None]
+    print('Resuming the interrupted push from {}: {} of {} scopes already created.'.format(
+        journal.path, len(operations) - len(remaining), len(operations)))
+
+    journal.resume()
+    with metrics.phase('create'):
+        errors = create_scopes(remaining, tree, rc,
+                               max_in_flight=site_config['max_in_flight'],
+                               cache=cache, journal=journal)
+    journal.finish(errors)
+    metrics.count('resumed_scopes', len(remaining))
+    metrics.count('created_scopes', len(remaining) - len(errors))
+    metrics.count('errors', len(errors))
+    print(json.dumps(errors))
+    return {'tenant': site_config['tenant'], 'scopes': None,
+            'planned': len(operations),
+            'created': len(operations) - len(errors), 'errors': errors}
+
+
+def apply_plan(site_config, metrics=None):
+    """
+    Create the scopes of a saved plan without downloading or collapsing the
+    annotations again.
+    """
+    metrics = metrics or RunMetrics('scope_builder', site_config.get('tenant'))
+    rc = get_client(site_config, metrics)
+    with open_cache(site_config) as cache:
+        summary = resume_push(site_config, rc, metrics, cache)
+        if summary is not None:
+            return summary
+        operations, tree = read_plan(site_config['plan_file'])
+        print('Applying {} scope operations from {}'.format(
+            len(operations), site_config['plan_file']))
+        with metrics.phase('create'):
+            errors = push_scopes(site_config, operations, tree, rc, cache=cache)
+    metrics.count('planned_scopes', len(operations))
+    metrics.count('created_scopes', len(operations) - len(errors))
+    metrics.count('errors', len(errors))
+    print(json.dumps(errors))
+    return {'tenant': site_config.get('tenant'), 'scopes': None,
+            'planned': len(operations),
+            'created': len(operations) - len(errors), 'errors': errors}
+
+
+def build_scopes(site_config, tenant_config, metrics=None):
+    metrics = metrics or RunMetrics('scope_builder', site_config['tenant'])
+    rc = get_client(site_config, metrics)
+
+    with open_cache(site_config) as cache:
+        # Finish an interrupted push before planning anything new
+        if site_config['push_scopes'] and site_config['command'] != 'plan':
+            summary = resume_push(site_config, rc, metrics, cache)
+            if summary is not None:
+                return summary
+
         root_scope_name = site_config['tenant']
-        parent = root_scope_name
-        scope = scopes.iloc[i].dropna().drop(labels=['IP'])
-        scope = shorten_scope(root_scope_name, scope,
-                              tenant_config['abbreviations'])
-        scope_long_name = ':'.join([root_scope_name]+list(scope))
-        if len(scope_long_name) > 400:
-            errors.append(scope_long_name)
-        for attribute in scope.index:
-            scope_name = parent + ':' + scope[attribute].strip()
-            if not scope_name in scope_ids:
-                if site_config['push_scopes']:
-                    print('[CREATING SCOPE]: {}'.format(scope_name))
-                    if attribute in inv_abbreviations and scope[attribute] in inv_abbreviations[attribute]:
-                        value = inv_abbreviations[attribute][scope[attribute]]
-                    else:
-                        value = scope[attribute]
-                    scope_ids[scope_name] = create_scope(
-                        parent=scope_ids[parent], scope_name=scope[attribute], tag_name=attribute, tag_value=value, rc=rc)
+        columns = tenant_config['columns']
+
+        # Download Annotations File for Root Scope and build the scope list,
+        # reusing the cached tables when the export has not changed
+        scopes = load_scopes(rc, root_scope_name, columns,
+                             chunksize=site_config['ingest_chunksize'],
+                             cache=open_annotation_cache(site_config),
+                             metrics=metrics, workers=site_config.get('shard_workers', 0))
+        metrics.count('scope_rows', len(scopes))
+
+        # Gather existing scopes and IDs
+        with metrics.phase('inventory'):
+            tree = ScopeTree(root_scope_name)
+            current_scopes = tenant_scopes(rc, root_scope_name, cache)
+            if current_scopes:
+                tree = ScopeTree.from_listing(root_scope_name, current_scopes)
+        metrics.count('existing_scopes', len(current_scopes or []))
+
+        # Profile the tier columns once for all the abbreviation checks
+        with metrics.phase('profile'):
+            profiles = profile_columns(scopes, columns)
+
+        with metrics.phase('abbreviations'):
+            if site_config['unattended']:
+                # Resolve every abbreviation from the rules file without prompting
+                auto_abbreviate(scopes, columns, root_scope_name,
+                                tenant_config['abbreviations'],
+                                load_abbreviation_rules(site_config['abbreviation_rules']),
+                                profiles)
+            else:
+                # Build common abbreviations
+                common_abbreviations(scopes, tenant_config['abbreviations'], profiles)
+
+                # Build abbreviations for long fields
+                long_abbreviations(scopes, tenant_config['abbreviations'], profiles)
+
+                # Remove invalid characters in scope names
+                remove_invalid_chars(scopes, tenant_config['abbreviations'], profiles)
+
+        print(tenant_config['abbreviations'])
+
+        # Plan the scopes missing from the tree
+        with metrics.phase('plan'):
+            operations, errors = plan_scopes(scopes, columns, root_scope_name,
+                                             tree, tenant_config['abbreviations'],
+                                             prompt=not site_config['unattended'])
+        metrics.count('planned_scopes', len(operations))
+
+        # Drop the scopes whose query would match nothing before any is created
+        if site_config.get('check_queries', True):
+            with metrics.phase('evaluate'):
+                operations, flagged = check_queries(scopes, COUNT_COLUMN, tree,
+                                                    operations, current_scopes)
+            print_flagged(flagged)
+            if flagged:
+                print('Dropped {} planned scopes that would match no annotations.'.format(
+                    len(flagged)))
+            metrics.count('dropped_scopes', len(flagged))
+
+        summary = {'tenant': root_scope_name, 'scopes': len(scopes),
+                   'planned': len(operations), 'created': 0}
+
+        # Save the plan for review, or create new scopes
+        if site_config['command'] == 'plan':
+            for operation in operations:
+                print('[NEW SCOPE]: {}'.format(operation['name']))
+            with metrics.phase('write_plan'):
+                write_plan(site_config['plan_file'], operations, tree)
+            print('Wrote {} scope operations to {}'.format(
+                len(operations), site_config['plan_file']))
+        elif site_config['push_scopes']:
+            with metrics.phase('create'):
+                failed = push_scopes(site_config, operations, tree, rc, cache=cache)
+            summary['created'] = len(operations) - len(failed)
+            metrics.count('created_scopes', summary['created'])
+            errors += failed
+        else:
+            for operation in operations:
+                print('[NEW SCOPE]: {}'.format(operation['name']))
+
+        metrics.count('errors', len(errors))
+        print(json.dumps(errors))
+        summary['errors'] = errors
+        return summary
+
+
+def sync_scopes(site_config, tenant_config, metrics=None):
+    """
+    Upload the changes of the local annotation file to the CMDB of the
+    tenant, then build its scopes from the updated export.  The build is
+    skipped if any batch failed to upload.
+    """
+    metrics = metrics or RunMetrics('scope_builder', site_config['tenant'])
+    if not site_config['annotations_file']:
+        raise Exception('The sync command needs --annotations_file')
+    errors = sync_annotations(get_client(site_config, metrics), site_config['tenant'],
+                              site_config['annotations_file'],
+                              batch_size=site_config['upload_batch_size'],
+                              max_in_flight=site_config['upload_concurrency'],
+                              metrics=metrics)
+    if errors:
+        metrics.count('errors', len(errors))
+        print(json.dumps(errors))
+        return {'tenant': site_config['tenant'], 'scopes': None, 'planned': 0,
+                'created': 0, 'errors': errors}
+    return build_scopes(site_config, tenant_config, metrics)
+
+
+class AnnotationState(object):
+    """
+    Annotation rows of a tenant kept in memory between the polls of the
+    watch command.
+
+    Each export is compared with the previous one row by row.  Only the rows
+    that were added, changed or removed, plus the rows under a subnet that
+    was, are collapsed again, and the number of rows on each tier path is
+    updated from them.  The paths that gain their first row are the scopes
+    the poll may need to create.
+
+    Rows are keyed by IP (VRF and IP when the export has a VRF column) and
+    the number of earlier rows with the same IP, so an IP listed twice
+    counts twice, as it does in a build.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.key = [ROW_KEY_COLUMN]
+        self.export = None
+        # Tier values of each row by key, and their networks in the form
+        # parse_ip_column returns with the key as index
+        self.rows = {}
+        self.networks = None
+        self.subnets = set()
+        # Tier path of each row after longest prefix match, for the rows with
+        # a value in every tier column, and the number of rows of each path
+        self.paths = {}
+        self.counts = {}
+        # Per column, the spelling each case-folded value was first seen in
+        self.spellings = [{} for _ in columns]
+
+    def read_export(self, file_path):
+        """
+        Read the key and tier columns of an export as text.  Rows without a
+        value in any tier column are dropped as read_annotations does, and
+        every other row is kept.  The key of a row is 'VRF|IP', or the IP
+        without a VRF column, with '#n' appended for the nth repeat of it.
+        """
+        header = pd.read_csv(file_path, nrows=0).columns
+        ip_key = ['VRF', 'IP'] if 'VRF' in header else ['IP']
+        export = pd.read_csv(file_path, usecols=ip_key + self.columns, dtype=str)
+        export = export[ip_key + self.columns].dropna(how='all', subset=self.columns)
+        export = export.reset_index(drop=True)
+        export['IP'] = export['IP'].str.strip()
+        key = export['IP'].astype(object)
+        if 'VRF' in header:
+            key = export['VRF'].fillna('').astype(object) + '|' + key
+        repeat = export.groupby(ip_key, dropna=False, sort=False).cumcount()
+        repeated = (repeat > 0).values
+        if repeated.any():
+            key[repeated] = key[repeated] + '#' + repeat[repeated].astype(str)
+        export.insert(0, ROW_KEY_COLUMN, key.values)
+        return export
+
+    def _normalize(self, i, values):
+        # Values seen before keep their spelling; new ones are merged among
+        # themselves by normalize_tier
+        spellings = self.spellings[i]
+        keys = values.str.strip().str.casefold()
+        canonical = keys.map(spellings).astype(object)
+        new = canonical.isna() & values.notna()
+        if new.any():
+            merged = normalize_tier(values[new].astype('category')).astype(object)
+            first = ~keys[new].duplicated().values
+            spellings.update(zip(keys[new][first].tolist(), merged[first].tolist()))
+            canonical[new] = merged
+        return canonical.where(canonical.notna(), None).tolist()
+
+    def _frame(self, keys):
+        frame = pd.DataFrame([self.rows[key] for key in keys], columns=self.columns,
+                             dtype=object)
+        networks = self.networks.loc[keys] if len(keys) else self.networks.iloc[:0]
+        for column in networks.columns:
+            frame[column] = networks[column].values
+        return frame
+
+    def update(self, export):
+        """
+        Apply a new export.  Returns the tier paths that gained their first
+        row and the counts of rows added, changed, deleted and collapsed.
+        """
+        if self.export is None:
+            added, changed, deletes = export, export.iloc[:0], export[self.key].iloc[:0]
+        else:
+            # The IP is part of the key, so only the tiers are compared
+            added, changed, deletes = diff_annotations(export, self.export, self.key,
+                                                       self.columns)
+        self.export = export
+
+        rows = pd.concat([added, changed], ignore_index=True)
+        version, prefix, hi, lo = ip_halves(parse_ip_column(rows['IP']))
+        parsed = pd.DataFrame({'Version': version, 'Prefix': prefix, 'NetHi': hi,
+                               'NetLo': lo}, index=key_index(rows, self.key))
+        removed = key_index(deletes, self.key)
+        tiers = [self._normalize(i, rows[column])
+                 for i, column in enumerate(self.columns)]
+        for key in removed.tolist():
+            del self.rows[key]
+        self.rows.update(zip(parsed.index.tolist(), zip(*tiers)))
+        touched = set(removed.tolist())
+        touched.update(parsed.index.tolist())
+
+        # The subnets that were removed, changed or added
+        def subnets(networks):
+            return networks[networks['Prefix'].values <
+                            np.where(networks['Version'].values == 4, 32, 128)]
+        if self.networks is None:
+            replaced = parsed.iloc[:0]
+            self.networks = parsed
+        else:
+            old = np.zeros(len(self.networks), dtype=bool)
+            position = self.networks.index.get_indexer(removed.append(parsed.index))
+            old[position[position >= 0]] = True
+            replaced = self.networks[old]
+            self.networks = pd.concat([self.networks[~old], parsed])
+        networks = pd.concat([subnets(replaced), subnets(parsed)])
+        self.subnets.difference_update(replaced.index.tolist())
+        self.subnets.update(subnets(parsed).index.tolist())
+
+        # A subnet that changed can change the tags every row under it
+        # inherits, whether or not the row itself changed
+        if len(networks) and len(touched) < len(self.rows):
+            networks = networks.drop_duplicates()
+            index = PrefixIndex(*[networks[column].values for column in
+                                  ['Version', 'NetHi', 'NetLo', 'Prefix']])
+            version, prefix, hi, lo = ip_halves(self.networks)
+            owner = index.lookup(version, hi, lo, prefix)
+            touched.update(self.networks.index[owner >= 0].tolist())
+
+        current = [key for key in touched if key in self.rows]
+        keys = current + list(self.subnets.difference(current))
+        # Collapsed in export order, so of two rows with the same network
+        # the same one wins as in a build
+        order = np.argsort(key_index(self.export, self.key).get_indexer(
+            pd.Index(keys, dtype=object)), kind='stable')
+        resolved = collapse_prefix_tags(self._frame([keys[i] for i in order]),
+                                        self.columns)
+        inverse = np.empty(len(order), dtype=np.int64)
+        inverse[order] = np.arange(len(order))
+        resolved = resolved.iloc[inverse[:len(current)]]
+        complete = resolved[self.columns].notna().all(axis=1).values
+
+        vanished = set()
+        for key in touched:
+            path = self.paths.pop(key, None)
+            if path is not None:
+                self.counts[path] -= 1
+                if self.counts[path] == 0:
+                    del self.counts[path]
+                    vanished.add(path)
+        paths = []
+        values = zip(*[resolved[column].tolist() for column in self.columns])
+        for key, path, keep in zip(current, values, complete):
+            if not keep:
+                continue
+            self.paths[key] = path
+            if path not in self.counts and path not in vanished:
+                paths.append(path)
+            self.counts[path] = self.counts.get(path, 0) + 1
+        return paths, {'added': len(added), 'changed': len(changed),
+                       'deleted': len(deletes), 'collapsed': len(current)}
+
+    def scope_list(self, paths=None):
+        """
+        Scope list of the given tier paths, or of every path with rows, in
+        the form group_scopes returns.
+        """
+        if paths is None:
+            paths = list(self.counts)
+        scopes = pd.DataFrame(paths, columns=self.columns, dtype=object)
+        scopes[COUNT_COLUMN] = [self.counts[path] for path in paths]
+        return scopes.sort_values(self.columns).reset_index(drop=True)
+
+
+def watch_cycle(site_config, tenant_config, state, watch, rules, metrics,
+                cache=None):
+    """
+    One poll of the watch command: apply the new export to the state and
+    create the scopes of the paths that gained their first row.  The scope
+    tree is listed again when watch has none, and then every path is
+    planned, since scopes may be missing anywhere in a fresh tree.  cache is
+    the scope cache of the watch session, if any.
+    """
+    root_scope_name = site_config['tenant']
+    columns = tenant_config['columns']
+    rc = get_client(site_config, metrics)
+    summary = {'tenant': root_scope_name, 'scopes': len(state.counts),
+               'planned': 0, 'created': 0, 'errors': []}
+
+    with downloaded_annotations(rc, root_scope_name, metrics) as file_path:
+        with metrics.phase('cache'):
+            digest = file_digest(file_path)
+        if digest == watch['digest'] and watch['tree'] is not None:
+            print('Annotations unchanged.')
+            return summary
+        with metrics.phase('parse'):
+            export = state.read_export(file_path)
+
+    with metrics.phase('delta'):
+        paths, changes = state.update(export)
+    watch['digest'] = digest
+    print('Annotation changes for {}: {} added, {} changed, {} deleted, {} rows collapsed, {} new scope paths.'.format(
+        root_scope_name, changes['added'], changes['changed'], changes['deleted'],
+        changes['collapsed'], len(paths)))
+    for name, value in changes.items():
+        metrics.count('annotations_' + name, value)
+    metrics.count('annotation_rows', len(state.rows))
+    summary['scopes'] = len(state.counts)
+
+    if watch['tree'] is None:
+        with metrics.phase('inventory'):
+            listing = tenant_scopes(rc, root_scope_name, cache,
+                                    refresh=watch['refresh'])
+            if listing is None:
+                raise Exception('Error listing the scopes of {}'.format(root_scope_name))
+            watch['tree'] = ScopeTree(root_scope_name)
+            if listing:
+                watch['tree'] = ScopeTree.from_listing(root_scope_name, listing)
+            watch['listing'] = list(listing)
+            watch['refresh'] = False
+        metrics.count('existing_scopes', len(listing))
+        paths = None
+    tree = watch['tree']
+
+    scopes = state.scope_list(paths)
+    metrics.count('scope_rows', len(scopes))
+    if len(scopes) == 0:
+        return summary
+
+    # New values are resolved against every value with rows, as a build
+    # would, so a short name never collides with one already in use
+    all_scopes = state.scope_list()
+    with metrics.phase('abbreviations'):
+        auto_abbreviate(all_scopes, columns, root_scope_name,
+                        tenant_config['abbreviations'], rules)
+    with metrics.phase('plan'):
+        operations, errors = plan_scopes(scopes, columns, root_scope_name, tree,
+                                         tenant_config['abbreviations'],
+                                         prompt=False)
+    metrics.count('planned_scopes', len(operations))
+    planned = len(operations)
+
+    if operations and site_config.get('check_queries', True):
+        with metrics.phase('evaluate'):
+            operations, flagged = check_queries(all_scopes, COUNT_COLUMN,
+                                                tree, operations, watch['listing'])
+        print_flagged(flagged)
+        metrics.count('dropped_scopes', len(flagged))
+
+    summary['planned'] = len(operations)
+    if site_config['push_scopes']:
+        with metrics.phase('create'):
+            failed = push_scopes(site_config, operations, tree, rc, cache=cache)
+        summary['created'] = len(operations) - len(failed)
+        metrics.count('created_scopes', summary['created'])
+        errors += failed
+        # The queries of the new scopes, for the query check of later polls
+        watch['listing'] += [
+            {'id': tree.ids[x['node']],
+             'short_query': {'type': 'eq', 'field': 'user_' + x['tag'],
+                             'value': x['value']}}
+            for x in operations if tree.ids[x['node']] is not None]
+        # Planned nodes that were not created have no id in the tree, so
+        # the next poll starts from a fresh listing
+        if summary['created'] < planned:
+            watch['tree'] = None
+            watch['refresh'] = True
+    else:
+        for operation in operations:
+            print('[NEW SCOPE]: {}'.format(operation['name']))
+
+    metrics.count('errors', len(errors))
+    if errors:
+        print(json.dumps(errors))
+    summary['errors'] = errors
+    return summary
+
+
+def watch_scopes(site_config, tenant_config, config_path='./scopes_config.json'):
+    """
+    Poll the CMDB export of the tenant every watch_interval seconds, for
+    watch_cycles polls or until interrupted, and create the scopes its new
+    annotation rows need.  The parsed rows and the scope tree stay in memory
+    between polls.  Each poll writes the metrics of its own cycle and saves
+    the abbreviations of the tenant.  The scope cache is opened once for the
+    whole session.
+    """
+    with open_cache(site_config) as cache:
+        if site_config['push_scopes']:
+            # Finish an interrupted push before watching
+            with collect_metrics(site_config, 'scope_builder') as metrics:
+                resume_push(site_config, get_client(site_config, metrics),
+                            metrics, cache)
+
+        rules = load_abbreviation_rules(site_config['abbreviation_rules'])
+        state = AnnotationState(tenant_config['columns'])
+        watch = {'digest': None, 'tree': None, 'listing': None, 'refresh': False}
+        cycle = 0
+        while True:
+            cycle += 1
+            start = time.time()
+            try:
+                with collect_metrics(site_config, 'scope_builder') as metrics:
+                    summary = watch_cycle(site_config, tenant_config, state, watch,
+                                          rules, metrics, cache)
+                print('[CYCLE {}] {} scope paths, {} planned, {} created, {} errors'.format(
+                    cycle, summary['scopes'], summary['planned'], summary['created'],
+                    len(summary['errors'])))
+            except Exception as e:
+                # The state may be half updated, so the next poll starts over
+                print('[ERROR] {}: {}'.format(site_config['tenant'], e))
+                state = AnnotationState(tenant_config['columns'])
+                watch = {'digest': None, 'tree': None, 'listing': None, 'refresh': True}
+            save_tenant_config(config_path, site_config['tenant'], tenant_config)
+            if site_config['watch_cycles'] and cycle >= site_config['watch_cycles']:
+                return
+            time.sleep(max(0, site_config['watch_interval'] - (time.time() - start)))
+
+
+def load_scopes_config(config_path):
+    try:
+        with open(config_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_tenant_config(config_path, tenant, tenant_config):
+    """
+    Merge the configuration of one tenant into the config file.  The file is
+    read again right before writing, so the entries of other tenants saved
+    in the meantime are kept, and replaced atomically so a reader never sees
+    a partial file.
+    """
+    scopes_config = load_scopes_config(config_path)
+    scopes_config[tenant] = tenant_config
+    write_atomic(config_path, json.dumps(scopes_config, indent=1))
+
+
+def tenant_site_config(site_config, tenant):
+    """
+    Site configuration of one tenant of a multi-tenant run: unattended, and
+    with a plan file, metrics files and annotation file of its own.
+    """
+    tenant_config = dict(site_config, tenant=tenant, unattended=True)
+    for key in ('plan_file', 'metrics_file', 'prometheus_file', 'annotations_file'):
+        if site_config.get(key):
+            root, ext = os.path.splitext(site_config[key])
+            tenant_config[key] = '{}_{}{}'.format(root, safe_name(tenant), ext)
+    return tenant_config
+
+
+def init_tenant_worker(semaphore):
+    set_global_limit(semaphore)
+
+
+def run_tenant(site_config, tenant_config, log_path):
+    """
+    Build, plan or apply one tenant in a worker process with its output
+    going to log_path.  Returns the tenant's summary and its updated
+    configuration.
+    """
+    start = time.time()
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            with collect_metrics(site_config, 'scope_builder') as metrics:
+                if site_config['command'] == 'apply':
+                    summary = apply_plan(site_config, metrics)
+                elif site_config['command'] == 'sync':
+                    summary = sync_scopes(site_config, tenant_config, metrics)
                 else:
-                    print('[NEW SCOPE]: {}'.format(scope_name))
-                    scope_ids[scope_name] = 1
-            # else:
-                #print('[EXISTING SCOPE]: {}'.format(scope_name))
-            parent = scope_name
-        i += 1
+                    summary = build_scopes(site_config, tenant_config, metrics)
+            summary['status'] = 'failed' if summary['errors'] else 'ok'
+        except Exception as e:
+            print('[ERROR] {}: {}'.format(site_config['tenant'], e))
+            summary = {'tenant': site_config['tenant'], 'status': 'error',
+                       'errors': [str(e)]}
+    summary['wall_time'] = round(time.time() - start, 3)
+    summary['log'] = log_path
+    return summary, tenant_config
 
-    print(json.dumps(errors))
+
+def build_tenants(site_config, config_path='./scopes_config.json'):
+    """
+    Run the command for several tenants of the config file at once, each in
+    its own worker process and unattended.  Requests in flight are capped by
+    api_concurrency across all workers.  Each tenant's configuration is saved
+    as soon as it finishes.  Returns the tenant summaries.
+    """
+    scopes_config = load_scopes_config(config_path)
+    if site_config['tenants'] == 'all':
+        tenants = sorted(scopes_config)
+    else:
+        tenants = [x.strip() for x in site_config['tenants'].split(',') if x.strip()]
+
+    results = []
+    runnable = []
+    for tenant in tenants:
+        if len(scopes_config.get(tenant, {}).get('columns', [])) == 0:
+            results.append({'tenant': tenant, 'status': 'skipped',
+                            'errors': ['no column configuration']})
+        else:
+            runnable.append(tenant)
+
+    if not os.path.isdir(site_config['log_dir']):
+        os.makedirs(site_config['log_dir'])
+    semaphore = multiprocessing.BoundedSemaphore(site_config['api_concurrency'])
+    with ProcessPoolExecutor(max_workers=site_config['workers'],
+                             initializer=init_tenant_worker,
+                             initargs=(semaphore,)) as executor:
+        futures = {}
+        for tenant in runnable:
+            log_path = os.path.join(site_config['log_dir'], '{}.log'.format(
+                safe_name(tenant)))
+            print('[STARTED] {} (log: {})'.format(tenant, log_path))
+            futures[executor.submit(run_tenant, tenant_site_config(site_config, tenant),
+                                    scopes_config[tenant], log_path)] = tenant
+        for future in as_completed(futures):
+            tenant = futures[future]
+            try:
+                summary, tenant_config = future.result()
+            except Exception as e:
+                summary = {'tenant': tenant, 'status': 'error', 'errors': [str(e)]}
+            else:
+                save_tenant_config(config_path, tenant, tenant_config)
+            print('[FINISHED] {} ({})'.format(tenant, summary['status']))
+            results.append(summary)
+    return results
+
+
+def print_summary(results):
+    print('{:<30} {:>8} {:>8} {:>8} {:>8} {:>7} {:>9}'.format(
+        'Tenant', 'Status', 'Scopes', 'Planned', 'Created', 'Errors', 'Time (s)'))
+    for result in sorted(results, key=lambda x: x['tenant']):
+        print('{:<30} {:>8} {:>8} {:>8} {:>8} {:>7} {:>9}'.format(
+            result['tenant'], result['status'],
+            '-' if result.get('scopes') is None else result['scopes'],
+            result.get('planned', '-'), result.get('created', '-'),
+            len(result['errors']), result.get('wall_time', '-')))
+    print(json.dumps({x['tenant']: x['errors'] for x in results if x['errors']}))
+
+
+def str_to_bool(value):
+    return str(value).lower() in ('true', 'yes', 'y', '1')
 
 
 def main():
@@ -284,6 +1866,128 @@ def main():
             'env': 'SCOPE_BUILDER_PUSH_SCOPES',
             'conf': 'push_scopes',
                     'default': False
+        },
+        'max_in_flight': {
+            'descr': 'Maximum number of scope create requests in flight at once',
+            'conf': 'max_in_flight',
+                    'type': int,
+                    'default': 8
+        },
+        'ingest_chunksize': {
+            'descr': 'Rows per chunk when reading the annotation export (0 reads it in one pass)',
+            'conf': 'ingest_chunksize',
+                    'type': int,
+                    'default': 0
+        },
+        'shard_workers': {
+            'descr': 'Processes that parse the annotation export and build the scope list, each on its own range of the address space (0 or 1 runs it in this process)',
+            'conf': 'shard_workers',
+                    'type': int,
+                    'default': 0
+        },
+        'plan_file': {
+            'descr': 'Scope plan file written by the plan command and read by the apply command',
+            'conf': 'plan_file',
+                    'default': 'scope_plan.jsonl'
+        },
+        'tenants': {
+            'descr': 'Comma delimited tenants of ./scopes_config.json to run unattended in parallel, or "all" (empty runs --tenant only)',
+            'conf': 'tenants',
+                    'default': ''
+        },
+        'workers': {
+            'descr': 'Tenants run at once in a multi-tenant run',
+            'conf': 'workers',
+                    'type': int,
+                    'default': 4
+        },
+        'api_concurrency': {
+            'descr': 'Maximum number of API requests in flight across all tenants of a multi-tenant run',
+            'conf': 'api_concurrency',
+                    'type': int,
+                    'default': 16
+        },
+        'log_dir': {
+            'descr': 'Directory for the per-tenant logs of a multi-tenant run',
+            'conf': 'log_dir',
+                    'default': 'tenant_logs'
+        },
+        'metrics_file': {
+            'descr': 'JSON file for the phase timings, API request statistics and counts of the run (empty disables it)',
+            'conf': 'metrics_file',
+                    'default': 'scope_builder_metrics.json'
+        },
+        'prometheus_file': {
+            'descr': 'Also write the run metrics to this Prometheus textfile collector file (ex: /var/lib/node_exporter/scope_builder.prom)',
+            'conf': 'prometheus_file',
+                    'default': ''
+        },
+        'annotations_file': {
+            'descr': 'Local annotation file whose changes the sync command uploads to the CMDB before building',
+            'conf': 'annotations_file',
+                    'default': ''
+        },
+        'upload_batch_size': {
+            'descr': 'Rows per CMDB upload batch of the sync command',
+            'conf': 'upload_batch_size',
+                    'type': int,
+                    'default': 5000
+        },
+        'upload_concurrency': {
+            'descr': 'CMDB upload batches in flight at once',
+            'conf': 'upload_concurrency',
+                    'type': int,
+                    'default': 4
+        },
+        'journal_dir': {
+            'descr': 'Directory for the per-tenant journals of scope creates, used to resume an interrupted push (empty disables them)',
+            'conf': 'journal_dir',
+                    'default': 'scope_journal'
+        },
+        'annotation_cache': {
+            'descr': 'Directory caching the parsed annotation export between runs (empty disables the cache)',
+            'conf': 'annotation_cache',
+                    'default': 'annotation_cache'
+        },
+        'scope_cache': {
+            'descr': 'SQLite file caching the scope inventory between runs (empty disables the cache)',
+            'conf': 'scope_cache',
+                    'default': 'scope_cache.db'
+        },
+        'cache_ttl': {
+            'descr': 'Seconds a cached scope inventory is used before it is refreshed from the cluster',
+            'conf': 'cache_ttl',
+                    'type': int,
+                    'default': 300
+        },
+        'unattended': {
+            'descr': 'Resolve abbreviations from rules instead of prompting for them (True/False)',
+            'conf': 'unattended',
+                    'type': str_to_bool,
+                    'default': False
+        },
+        'abbreviation_rules': {
+            'descr': 'JSON file of abbreviation rules used in unattended mode',
+            'conf': 'abbreviation_rules',
+                    'default': ''
+        },
+        'check_queries': {
+            'descr': 'Drop planned scopes whose query would match no annotations before creating any (True/False)',
+            'conf': 'check_queries',
+                    'type': str_to_bool,
+                    'default': True
+        },
+        'watch_interval': {
+            'descr': 'Seconds between the annotation polls of the watch command',
+            'conf': 'watch_interval',
+                    'type': int,
+                    'default': 300
+        },
+        'watch_cycles': {
+            'descr': 'Polls the watch command makes before it exits (0 watches until interrupted)',
+            'conf': 'watch_cycles',
+                    'type': int,
+                    'default': 0
         }
     }
 
@@ -299,13 +2003,20 @@ def main():
             default = conf_vars[item]['default']
         elif 'env' in conf_vars[item]:
             default = os.environ.get(conf_vars[item]['env'], None)
-        parser.add_argument('--'+item, default=default, help=descr)
+        parser.add_argument('--'+item, default=default, help=descr,
+                            type=conf_vars[item].get('type', str))
+    parser.add_argument('command', nargs='?', default='build', choices=['build', 'plan', 'apply', 'sync', 'watch'],
+                        help='build (default) plans and pushes or prints new scopes in one run, plan saves them to the plan file for review, apply creates the scopes of a saved plan, sync uploads the changes of the annotations file before building and watch polls the annotations and creates the scopes of new rows until interrupted')
     args = parser.parse_args()
 
-    site_config = {}
+    site_config = {'command': args.command}
     for arg in vars(args):
+        if arg not in conf_vars:
+            continue
         attribute = getattr(args, arg)
-        if attribute == None:
+        if attribute == None and arg == 'tenant' and args.tenants:
+            site_config['tenant'] = None
+        elif attribute == None:
             if 'hidden' in conf_vars[arg]:
                 site_config[conf_vars[arg]['conf']] = getpass.getpass(
                     '{}: '.format(conf_vars[arg]['descr']))
@@ -315,12 +2026,24 @@ def main():
         else:
             site_config[conf_vars[arg]['conf']] = attribute
 
-    try:
-        with open('./scopes_config.json') as f:
-            scopes_config = json.load(f)
-            print('Previous configuration loaded.')
-    except:
-        scopes_config = {}
+    if site_config['command'] == 'watch' and (site_config['tenants'] or
+                                              not site_config['unattended']):
+        print('The watch command runs one tenant (--tenant) with --unattended True.')
+        return
+
+    if site_config['tenants']:
+        print_summary(build_tenants(site_config))
+        return
+
+    if site_config['command'] == 'apply':
+        with collect_metrics(site_config, 'scope_builder') as metrics:
+            apply_plan(site_config, metrics)
+        return
+
+    scopes_config = load_scopes_config('./scopes_config.json')
+    if len(scopes_config):
+        print('Previous configuration loaded.')
+    else:
         print('No previous configuration loaded.')
 
     if site_config['tenant'] in scopes_config:
@@ -329,16 +2052,30 @@ def main():
         tenant_config = {'columns': [], 'abbreviations': {}}
 
     if len(tenant_config['columns']) == 0:
+        if site_config['unattended']:
+            print('No column configuration found for {} in ./scopes_config.json.'.format(
+                site_config['tenant']))
+            return
         tenant_config['columns'] = get_columns()
     else:
         print('Previous column configuration found.  Using {} to build scope tree.'.format(
             json.dumps(tenant_config['columns'])))
 
-    build_scopes(site_config, tenant_config)
+    if site_config['command'] == 'watch':
+        try:
+            watch_scopes(site_config, tenant_config)
+        except KeyboardInterrupt:
+            print('Stopped watching {}.'.format(site_config['tenant']))
+        save_tenant_config('./scopes_config.json', site_config['tenant'], tenant_config)
+        return
+
+    with collect_metrics(site_config, 'scope_builder') as metrics:
+        if site_config['command'] == 'sync':
+            sync_scopes(site_config, tenant_config, metrics)
+        else:
+            build_scopes(site_config, tenant_config, metrics)
 
-    scopes_config[site_config['tenant']] = tenant_config
-    with open('./scopes_config.json', 'w') as outfile:
-        json.dump(scopes_config, outfile, indent=1)
+    save_tenant_config('./scopes_config.json', site_config['tenant'], tenant_config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+"""
+On-disk cache of the scope inventory of each tenant, shared by
+scope_builder.py and clean.py.
+
+Every run used to pull the full /openapi/v1/app_scopes listing of the cluster
+and filter it by name and root scope in Python.  ScopeCache keeps the scopes
+of each tenant in SQLite, keyed by scope id, with name, parent, root, query
+and updated_at:
+
+* within the TTL a run reads the tenant's scopes from the cache and sends no
+  listing request at all,
+* after the TTL only the tenant's scopes are listed (root_app_scope_id) and
+  the cache is reconciled with them: changed rows (by updated_at) are
+  rewritten and scopes that are gone are dropped, and
+* scopes created or deleted by the scripts themselves are written through as
+  soon as the cluster confirms them, so the cache stays current between
+  refreshes.
+"""
+
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tenants (
+    name TEXT PRIMARY KEY,
+    root_id TEXT NOT NULL,
+    refreshed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scopes (
+    id TEXT PRIMARY KEY,
+    root_id TEXT NOT NULL,
+    parent_id TEXT,
+    name TEXT NOT NULL,
+    short_name TEXT NOT NULL,
+    query TEXT,
+    updated_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS scopes_root ON scopes (root_id);
+'''
+
+
+class ScopeCache(object):
+    """
+    SQLite backed scope inventory.  Safe to share between worker threads.
+    """
+
+    def __init__(self, path, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def root_id(self, tenant):
+        with self._lock:
+            row = self._db.execute('SELECT root_id FROM tenants WHERE name = ?',
+                                   (tenant,)).fetchone()
+        return row[0] if row else None
+
+    def fresh(self, tenant):
+        with self._lock:
+            row = self._db.execute('SELECT refreshed_at FROM tenants WHERE name = ?',
+                                   (tenant,)).fetchone()
+        return row is not None and time.time() - row[0] < self.ttl
+
+    def scopes(self, tenant):
+        """
+        The cached scopes of a tenant, root first, in the shape of the
+        app_scopes listing.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT s.id, s.root_id, s.parent_id, s.name, s.short_name, '
+                's.query, s.updated_at FROM scopes s JOIN tenants t '
+                'ON s.root_id = t.root_id WHERE t.name = ? '
+                'ORDER BY s.parent_id IS NOT NULL', (tenant,)).fetchall()
+        return [{'id': row[0], 'root_app_scope_id': row[1],
+                 'parent_app_scope_id': row[2], 'name': row[3],
+                 'short_name': row[4],
+                 'query': json.loads(row[5]) if row[5] else None,
+                 'updated_at': row[6]} for row in rows]
+
+    def reconcile(self, tenant, root_id, listing):
+        """
+        Bring the cache of a tenant in line with a fresh listing of its
+        scopes, touching only the rows that changed.
+        """
+        with self._lock, self._db:
+            # Scopes cached under a root scope that has since been replaced
+            self._db.execute('DELETE FROM scopes WHERE root_id IN (SELECT root_id '
+                             'FROM tenants WHERE name = ? AND root_id != ?)',
+                             (tenant, root_id))
+            cached = dict(self._db.execute(
+                'SELECT id, updated_at FROM scopes WHERE root_id = ?', (root_id,)))
+            changed = [scope for scope in listing if scope['id'] not in cached or
+                       scope.get('updated_at') is None or
+                       cached[scope['id']] != scope['updated_at']]
+            self._db.executemany(
+                'INSERT OR REPLACE INTO scopes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [self._row(scope) for scope in changed])
+            gone = set(cached) - set(scope['id'] for scope in listing)
+            self._db.executemany('DELETE FROM scopes WHERE id = ?',
+                                 [(scope_id,) for scope_id in gone])
+            self._db.execute('INSERT OR REPLACE INTO tenants VALUES (?, ?, ?)',
+                             (tenant, root_id, time.time()))
+        return len(changed), len(gone)
+
+    def store(self, scope):
+        """
+        Write through a scope created by this run.
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO scopes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             self._row(scope))
+
+    def remove(self, scope_id):
+        """
+        Write through a scope deleted by this run.
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM scopes WHERE id = ?', (scope_id,))
+
+    @staticmethod
+    def _row(scope):
+        return (scope['id'], scope['root_app_scope_id'],
+                scope.get('parent_app_scope_id'), scope['name'],
+                scope.get('short_name', scope['name'].split(':')[-1]),
+                json.dumps(scope.get('query')), scope.get('updated_at'))
+
+
+@contextlib.contextmanager
+def open_cache(site_config):
+    """
+    Open the scope cache of a run, or yield None when it is disabled.  A run
+    or watch session opens it once and its connection is closed when the
+    block exits.
+    """
+    if not site_config.get('scope_cache'):
+        yield None
+        return
+    cache = ScopeCache(site_config['scope_cache'],
+                       ttl=site_config.get('cache_ttl', 300))
+    try:
+        yield cache
+    finally:
+        cache.close()
+
+
+def tenant_scopes(rc, tenant, cache=None, refresh=False):
+    """
+    Return the scopes of a tenant (the root scope first), from the cache
+    while it is fresh and otherwise from the cluster, or None when the
+    listing fails.  refresh lists them from the cluster even while the cache
+    is fresh.  Once the root scope id is known only the tenant's scopes are
+    listed.
+    """
+    if cache is not None and not refresh and cache.fresh(tenant):
+        print('Using cached scope inventory for {}.'.format(tenant))
+        return cache.scopes(tenant)
+
+    root_id = cache.root_id(tenant) if cache is not None else None
+    uris = ['/openapi/v1/app_scopes/']
+    if root_id:
+        # Falls back to the full listing if the root scope was replaced
+        uris.insert(0, '/openapi/v1/app_scopes?root_app_scope_id=' + root_id)
+    for uri in uris:
+        resp = rc.get(uri)
+        if resp.status_code != 200:
+            return None
+        listing = resp.json()
+        root = [x for x in listing if x['name'] == tenant and
+                not x.get('parent_app_scope_id')]
+        if len(root):
+            break
+    else:
+        return []
+    listing = [x for x in listing if x['root_app_scope_id'] == root[0]['id']]
+    listing.sort(key=lambda x: x['id'] != root[0]['id'])
+    if cache is not None:
+        changed, gone = cache.reconcile(tenant, root[0]['id'], listing)
+        print('Refreshed scope inventory for {}: {} changed, {} removed.'.format(
+            tenant, changed, gone))
+    return listing
@@ -0,0 +1,114 @@
+"""
+Append-only journal of the scope creates of a push, so scope_builder.py can
+resume a run that was interrupted.
+
+Before the first create of a push, the journal of the tenant is started over
+with every planned operation, in the form of a plan file line.  Every create
+the cluster confirms or refuses is then appended as it completes, with the
+id of the new scope, and a last line marks the push finished.  Lines are
+flushed as they are written, so a crash loses at most the line being
+written, and a torn line is skipped on reading.
+
+A push that has no finished line was interrupted.  The next run for the
+tenant resumes it: the scopes already created get their recorded ids back
+and only the scopes that failed or were never sent are created, without
+downloading the annotations again.
+"""
+
+import json
+import os
+import time
+
+from local_files import safe_name
+
+
+class ScopeJournal(object):
+    """
+    Journal file of one tenant.
+    """
+
+    def __init__(self, directory, tenant):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, safe_name(tenant) + '.jsonl')
+        self.tenant = tenant
+        self._file = None
+
+    def start(self, lines):
+        """
+        Start the journal of a new push with its planned operations.
+        """
+        self._file = open(self.path, 'w')
+        self._write({'event': 'start', 'tenant': self.tenant, 'time': time.time(),
+                     'operations': len(lines)})
+        for line in lines:
+            self._write(dict(line, event='planned'))
+        os.fsync(self._file.fileno())
+
+    def resume(self):
+        """
+        Reopen the journal of an interrupted push to append to it.
+        """
+        self._file = open(self.path, 'a')
+        if self._file.tell() > 0:
+            # A torn last line must not swallow the next entry
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def created(self, operation, scope_id):
+        self._write({'event': 'created', 'name': operation['name'], 'id': scope_id})
+
+    def failed(self, operation):
+        self._write({'event': 'failed', 'name': operation['name']})
+
+    def finish(self, errors):
+        self._write({'event': 'finished', 'time': time.time(), 'errors': len(errors)})
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def interrupted(self):
+        """
+        Return the planned operation lines and the ids of the scopes already
+        created ({name: id}) of an interrupted push, or None when the last
+        push of the tenant finished or there is no journal.
+        """
+        if not os.path.exists(self.path):
+            return None
+        lines = []
+        created = {}
+        finished = True
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                event = entry.pop('event', None)
+                if event == 'start':
+                    if entry.get('tenant') != self.tenant:
+                        return None
+                    lines, created, finished = [], {}, False
+                elif event == 'planned':
+                    lines.append(entry)
+                elif event == 'created':
+                    created[entry['name']] = entry['id']
+                elif event == 'finished':
+                    finished = True
+        if finished:
+            return None
+        return lines, created
+
+
+def open_journal(site_config):
+    """
+    The journal of a run, or None when journaling is disabled.
+    """
+    if not site_config.get('journal_dir'):
+        return None
+    return ScopeJournal(site_config['journal_dir'], site_config['tenant'])
@@ -0,0 +1,317 @@
+"""
+Local evaluation of scope queries for scope_builder.py, so that scopes which
+would match nothing are found before they are pushed.
+
+Every scope built by scope_builder.py has an eq query on one annotation
+column, and a scope only holds what its parent holds.  Rather than the
+annotation rows themselves, the evaluator indexes the scope list: its rows
+are the distinct combinations of tier values after longest prefix match,
+each with its number of annotation rows, and an eq query on a tier column
+matches either all or none of the annotation rows of a combination.
+
+The index codes the values of each tier column, so the rows of one value
+under a scope are a sorted slice of row numbers.  The tree is evaluated one
+level at a time: the rows held by each scope are handed to its children with
+one sorted lookup of (parent, value) for the whole level.  Siblings are
+taken in order, existing scopes first, and a scope only keeps the rows no
+earlier sibling holds, as the cluster gives a workload to one scope per
+level.
+
+A planned scope is flagged as
+
+* empty when its query matches nothing its parent holds,
+* duplicate when it matches the same members as an earlier sibling, and
+* shadowed when earlier siblings hold everything it matches,
+
+and is dropped from the plan, with the scopes below it as skipped.
+"""
+
+import numpy as np
+import pandas as pd
+
+EMPTY = np.zeros(0, dtype=np.int64)
+
+
+class QueryIndex(object):
+    """
+    Inverted index from (column, value) to the sorted row numbers of a scope
+    list, with the annotation row count of each row.  Values are coded per
+    column, and columns are indexed on first use.
+    """
+
+    def __init__(self, scopes, count_column):
+        self.scopes = scopes
+        self.counts = scopes[count_column].to_numpy(np.int64)
+        self.rows = np.arange(len(scopes), dtype=np.int64)
+        self.columns = {}
+
+    def column(self, column):
+        """
+        The code of each row of a column and the codes of its values, or None
+        when the scope list has no such column.
+        """
+        if column not in self.columns:
+            if column not in self.scopes.columns:
+                return None
+            codes, values = pd.factorize(self.scopes[column].values)
+            self.columns[column] = (codes.astype(np.int64), pd.Index(values))
+        return self.columns[column]
+
+    def codes(self, column, values):
+        """
+        Codes of values of a column, -1 for those no row has.
+        """
+        return self.column(column)[1].get_indexer(pd.Index(values, dtype=object))
+
+    def split(self, rows, column):
+        """
+        Split sorted row numbers by their value of column: {code: rows}, each
+        part sorted.
+        """
+        codes = self.column(column)[0][rows]
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        bounds = np.flatnonzero(np.diff(codes)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(codes)]))
+        return dict((codes[start], rows[order[start:end]])
+                    for start, end in zip(starts, ends)
+                    if len(codes) and codes[start] >= 0)
+
+    def members(self, rows):
+        """
+        Number of annotation rows of the scope list rows.
+        """
+        return int(self.counts[rows].sum())
+
+
+def scope_query(scope):
+    """
+    The (column, value) of the eq query on an annotation column of a scope
+    from the /app_scopes listing, or None for any other query.
+    """
+    query = scope.get('short_query') or scope.get('query')
+    # The full query of a scope is its parent's query and its own
+    while query and query.get('type') == 'and' and query.get('filters'):
+        query = query['filters'][-1]
+    if not query or query.get('type') != 'eq' or \
+            not str(query.get('field', '')).startswith('user_'):
+        return None
+    return query['field'][len('user_'):], query.get('value')
+
+
+def check_siblings(index, tree, queries, planned, siblings, rows):
+    """
+    Evaluate the children of one scope holding rows, in order, each taking
+    only what no earlier sibling holds.  queries holds the queries of the
+    existing scopes.  Returns the rows of each child that is kept and the
+    flagged ones.
+    """
+    split = {}
+    first = {}
+    matched = {}
+    members = {}
+    flagged = []
+    for node in siblings:
+        if node in planned:
+            query = planned[node]['tag'], planned[node]['value']
+        else:
+            query = queries.get(node)
+        if query is None or index.column(query[0]) is None:
+            # Unknown query: anything below is checked against the parent,
+            # but it takes nothing from its siblings
+            members[node] = rows
+            continue
+        if query[0] not in split:
+            split[query[0]] = index.split(rows, query[0])
+        node_rows = own = split[query[0]].get(index.codes(query[0], [query[1]])[0], EMPTY)
+        if query in first:
+            own = EMPTY
+        for other_rows in matched.values():
+            own = np.setdiff1d(own, other_rows, assume_unique=True)
+
+        if node in planned and len(own) == 0:
+            kind, sibling = 'empty', None
+            if len(node_rows) and query in first:
+                kind, sibling = 'duplicate', first[query]
+            elif len(node_rows):
+                kind = 'shadowed'
+                for other, other_rows in matched.items():
+                    if np.array_equal(node_rows, other_rows):
+                        kind, sibling = 'duplicate', other
+                        break
+                    if sibling is None and len(np.intersect1d(
+                            node_rows, other_rows, assume_unique=True)):
+                        sibling = other
+            flagged.append((kind, planned[node], index.members(node_rows),
+                            tree.full_name(sibling) if sibling is not None else None))
+            continue
+        if query not in first:
+            first[query] = node
+            matched[node] = node_rows
+        members[node] = own
+    return members, flagged
+
+
+def check_queries(scopes, count_column, tree, operations, current_scopes=None):
+    """
+    Evaluate the queries of the planned operations against the scope list.
+    Returns the operations that would match something and the flagged ones
+    as (kind, operation, members matched, sibling) tuples, where sibling is
+    the name of the scope a duplicate or shadowed scope loses to.
+    """
+    index = QueryIndex(scopes, count_column)
+    size = len(tree)
+    parent_of = np.array(tree.parents, dtype=np.int64)
+    existing = np.array([x is not None for x in tree.ids], dtype=bool)
+    planned = dict((operation['node'], operation) for operation in operations)
+    is_planned = np.zeros(size, dtype=bool)
+    is_planned[list(planned)] = True
+
+    # The query of each node as a column number and a value code: column -1
+    # for a query on anything but a tier column, code -1 for a value no row
+    # has
+    queries = {}
+    by_node = dict((scope_id, node) for node, scope_id in enumerate(tree.ids)
+                   if scope_id is not None)
+    for scope in current_scopes or []:
+        if scope['id'] in by_node and by_node[scope['id']] not in planned:
+            queries[by_node[scope['id']]] = scope_query(scope)
+    nodes = np.array(list(planned) + list(queries), dtype=np.int64)
+    tags = pd.Series([x['tag'] for x in planned.values()] +
+                     [x[0] if x else None for x in queries.values()], dtype=object)
+    values = pd.Series([x['value'] for x in planned.values()] +
+                       [x[1] if x else None for x in queries.values()], dtype=object)
+    tag_codes, tags = pd.factorize(tags)
+    columns = []
+    column_of = np.full(size, -1, dtype=np.int64)
+    code_of = np.full(size, -1, dtype=np.int64)
+    for tag_code, column in enumerate(tags):
+        if index.column(column) is None:
+            continue
+        selected = tag_codes == tag_code
+        column_of[nodes[selected]] = len(columns)
+        code_of[nodes[selected]] = index.codes(column, values.values[selected])
+        columns.append(column)
+
+    # Only the planned scopes, their ancestors and the siblings of both are
+    # needed
+    needed = is_planned.copy()
+    frontier = np.flatnonzero(is_planned)
+    while len(frontier):
+        frontier = parent_of[frontier]
+        frontier = frontier[frontier > 0]
+        frontier = frontier[~needed[frontier]]
+        needed[frontier] = True
+    has_children = np.zeros(size, dtype=bool)
+    has_children[parent_of[np.flatnonzero(needed)]] = True
+    siblings = np.arange(1, size)
+    # A node that is neither on the cluster nor planned (one a dry run
+    # printed earlier) holds nothing
+    siblings = siblings[has_children[parent_of[siblings]] &
+                        (existing | is_planned)[siblings]]
+    # Existing scopes were created first and take precedence
+    siblings = siblings[np.lexsort((siblings, ~existing[siblings],
+                                    parent_of[siblings]))]
+    sibling_parents = parent_of[siblings]
+    starts = np.flatnonzero(np.r_[True, sibling_parents[1:] != sibling_parents[:-1]]) \
+        if len(siblings) else EMPTY
+    group_parents = sibling_parents[starts]
+    ends = np.r_[starts[1:], len(siblings)]
+
+    # Siblings with queries on one column never overlap, so the rows of all
+    # such parents are handed to their children with one lookup of (parent,
+    # value) per column.  Parents with mixed or unknown queries below them
+    # are evaluated one by one.
+    parent_column = np.full(size, -1, dtype=np.int64)
+    if len(siblings):
+        low = np.minimum.reduceat(column_of[siblings], starts)
+        high = np.maximum.reduceat(column_of[siblings], starts)
+        simple = (low == high) & (low >= 0)
+        parent_column[group_parents[simple]] = low[simple]
+    duplicate_of = np.full(size, -1, dtype=np.int64)
+    tables = []
+    for number, column in enumerate(columns):
+        codes = index.column(column)[0]
+        width = len(index.column(column)[1]) + 1
+        nodes = siblings[(parent_column[sibling_parents] == number) &
+                         (code_of[siblings] >= 0)]
+        keys = parent_of[nodes] * width + code_of[nodes] + 1
+        order = np.argsort(keys, kind='stable')
+        keys, nodes = keys[order], nodes[order]
+        first = np.r_[True, keys[1:] != keys[:-1]] if len(keys) else EMPTY.astype(bool)
+        winners = np.maximum.accumulate(np.where(first, np.arange(len(keys)), 0)) \
+            if len(keys) else EMPTY
+        duplicate_of[nodes[~first]] = nodes[winners[~first]]
+        tables.append((codes, width, keys[first], nodes[first]))
+
+    flagged = []
+    evaluated = np.zeros(size, dtype=bool)
+    nodes = np.zeros(len(index.rows), dtype=np.int64)
+    rows = index.rows
+    while len(rows):
+        keep = has_children[nodes]
+        nodes, rows = nodes[keep], rows[keep]
+        next_nodes, next_rows = [], []
+        pair_column = parent_column[nodes]
+        for number, (codes, width, keys, targets) in enumerate(tables):
+            selected = pair_column == number
+            if not selected.any() or len(keys) == 0:
+                continue
+            pair_keys = nodes[selected] * width + codes[rows[selected]] + 1
+            position = np.minimum(np.searchsorted(keys, pair_keys), len(keys) - 1)
+            hit = keys[position] == pair_keys
+            next_nodes.append(targets[position[hit]])
+            next_rows.append(rows[selected][hit])
+        for parent in np.unique(nodes[pair_column < 0]).tolist():
+            group = np.searchsorted(group_parents, parent)
+            children = siblings[starts[group]:ends[group]]
+            members, parent_flagged = check_siblings(
+                index, tree, queries, planned, children.tolist(),
+                np.sort(rows[nodes == parent]))
+            flagged += parent_flagged
+            evaluated[children] = True
+            for node, node_rows in members.items():
+                next_nodes.append(np.full(len(node_rows), node, dtype=np.int64))
+                next_rows.append(node_rows)
+
+        next_nodes = np.concatenate(next_nodes) if next_nodes else EMPTY
+        next_rows = np.concatenate(next_rows) if next_rows else EMPTY
+        held = np.zeros(size, dtype=bool)
+        held[next_nodes] = True
+        present = np.zeros(size, dtype=bool)
+        present[nodes[pair_column >= 0]] = True
+        reached = siblings[present[sibling_parents]]
+        evaluated[reached] = True
+        for node in reached[is_planned[reached] & ~held[reached]].tolist():
+            kind, sibling, node_rows = 'empty', None, EMPTY
+            first = duplicate_of[node]
+            if first >= 0 and held[first]:
+                kind, sibling = 'duplicate', tree.full_name(first)
+                node_rows = next_rows[next_nodes == first]
+            flagged.append((kind, planned[node], index.members(node_rows), sibling))
+        keep = needed[next_nodes]
+        nodes, rows = next_nodes[keep], next_rows[keep]
+
+    # A planned scope below a parent that holds nothing matches nothing, and
+    # the scopes below a dropped one are never created
+    dropped = set(operation['node'] for _, operation, _, _ in flagged)
+    keep = []
+    for operation in operations:
+        if operation['parent_node'] in dropped:
+            dropped.add(operation['node'])
+            flagged.append(('skipped', operation, 0, None))
+        elif not evaluated[operation['node']]:
+            dropped.add(operation['node'])
+            flagged.append(('empty', operation, 0, None))
+        elif operation['node'] not in dropped:
+            keep.append(operation)
+    return keep, flagged
+
+
+def print_flagged(flagged):
+    notes = {'duplicate': ' ({} annotation rows, same as {})',
+             'shadowed': ' ({} annotation rows, already held by {} and earlier siblings)'}
+    for kind, operation, members, sibling in flagged:
+        note = notes[kind].format(members, sibling) if kind in notes else ''
+        print('[{} SCOPE]: {}{}'.format(kind.upper(), operation['name'], note))
@@ -0,0 +1,189 @@
+"""
+Shared Tetration API transport for scope_builder.py and clean.py.
+
+TetClient wraps tetpyclient's RestClient with
+* a keep-alive connection pool sized to the number of worker threads,
+* retries with exponential backoff and full jitter on 429 and 5xx responses
+  and on connection errors, honouring Retry-After, and
+* no resends of a POST that may have reached the cluster: a POST is retried
+  on 429 and 503 and when the connection could not be made, never after a
+  read timeout or a dropped connection, and
+* an AIMD concurrency limit shared by every thread using the client: each
+  successful request raises the limit by 1/limit (about one more request in
+  flight per round of successes) and pushback from the cluster halves it.
+
+That lets a run go as fast as a given cluster tolerates without hand tuning
+the worker count, and keeps one transient 503 from failing a create.  When
+several tenants are built in parallel processes, set_global_limit installs a
+semaphore shared by all of them on top of each client's own limit.  Given a
+RunMetrics, the client records the latency and status of every attempt.
+"""
+
+import random
+import threading
+import time
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from tetpyclient import RestClient
+
+# Statuses that mean the cluster is overloaded or briefly unavailable
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# A POST answered with these was not processed, so resending cannot create
+# a duplicate
+POST_RETRY_STATUSES = (429, 503)
+# HTTP method behind each RestClient call that is not named after one
+HTTP_METHODS = {'download': 'get', 'upload': 'post'}
+
+# Semaphore shared by every process of a multi-tenant run, capping the
+# requests in flight across all of them
+_global_limit = None
+
+
+def set_global_limit(semaphore):
+    global _global_limit
+    _global_limit = semaphore
+
+
+def request_unsent(exc):
+    """
+    Whether a requests exception was raised before the request reached the
+    cluster: a connect timeout or a refused or unresolvable connection.
+    After any other error the cluster may have processed the request.
+    """
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        reason = getattr(exc.args[0], 'reason', exc.args[0])
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+class AdaptiveLimiter(object):
+    """
+    Additive increase / multiplicative decrease limit on requests in flight.
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=8, cooldown=1.0):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, congested=False):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.time()
+            if congested:
+                # Responses already in flight when the cluster pushed back
+                # report the same congestion, so only halve once per cooldown
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class TetClient(object):
+    """
+    Drop-in replacement for RestClient (get, post, put, delete, download and
+    upload) that is safe to share between worker threads.
+    """
+
+    def __init__(self, url, credentials_file, workers=8, max_retries=5,
+                 backoff=0.5, max_backoff=30.0, verify=False, metrics=None):
+        # Retries are handled here, not by tetpyclient
+        self.rc = RestClient(url, credentials_file=credentials_file,
+                             verify=verify, max_retries=1)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1),
+                              max_retries=0)
+        self.rc.session.mount('https://', adapter)
+        self.rc.session.mount('http://', adapter)
+        self.limiter = AdaptiveLimiter(maximum=max(workers, 1))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.metrics = metrics
+
+    def backoff_delay(self, attempt, resp=None):
+        """
+        Full jitter exponential backoff, unless the cluster said how long to
+        wait.
+        """
+        if resp is not None and resp.headers.get('Retry-After', '').isdigit():
+            return min(float(resp.headers['Retry-After']), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, *args, **kwargs):
+        retry_statuses = POST_RETRY_STATUSES if method == 'post' else RETRY_STATUSES
+        # download and upload take the local file first
+        uri_path = args[1] if method in ('download', 'upload') else args[0]
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            if _global_limit is not None:
+                _global_limit.acquire()
+            resp = None
+            start = time.time()
+            try:
+                resp = getattr(self.rc, method)(*args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.max_retries or (method == 'post' and
+                                                   not request_unsent(e)):
+                    raise
+            finally:
+                if self.metrics is not None:
+                    self.metrics.request(
+                        HTTP_METHODS.get(method, method), uri_path,
+                        'error' if resp is None else resp.status_code,
+                        time.time() - start)
+                if _global_limit is not None:
+                    _global_limit.release()
+                self.limiter.release(
+                    congested=resp is None or resp.status_code in RETRY_STATUSES)
+            if resp is not None and (resp.status_code not in retry_statuses or
+                                     attempt >= self.max_retries):
+                return resp
+            time.sleep(self.backoff_delay(attempt, resp))
+            attempt += 1
+
+    def get(self, uri_path='', **kwargs):
+        return self.request('get', uri_path, **kwargs)
+
+    def post(self, uri_path='', **kwargs):
+        return self.request('post', uri_path, **kwargs)
+
+    def put(self, uri_path='', **kwargs):
+        return self.request('put', uri_path, **kwargs)
+
+    def delete(self, uri_path='', **kwargs):
+        return self.request('delete', uri_path, **kwargs)
+
+    def download(self, file_path, uri_path, **kwargs):
+        # A failed download leaves the error body in file_path; a retry
+        # overwrites it
+        return self.request('download', file_path, uri_path, **kwargs)
+
+    def upload(self, file_path, uri_path, **kwargs):
+        return self.request('upload', file_path, uri_path, **kwargs)
+
+
+def get_client(site_config, metrics=None):
+    """
+    Create the API client for a run, with its connection pool and
+    concurrency limit sized to the run's max_in_flight.
+    """
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return TetClient(site_config['url'], site_config['creds'],
+                     workers=site_config.get('max_in_flight', 8), metrics=metrics)